@@ -1,3 +1,447 @@
-from django.contrib import admin
+"""
+Admin for the salon.
 
-# Register your models here.
+Appointments and clients grow without bound, so their changelists use
+``KeysetModelAdmin``: pages are read with ``WHERE (date, id) < cursor``
+instead of ``OFFSET``, the row count is cached (and estimated from the
+query plan on PostgreSQL), and related objects shown in ``list_display`` are
+joined or prefetched, which keeps every page at the same handful of queries
+however deep it is.
+"""
+import datetime
+import hashlib
+import json
+
+from django import forms
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.cache import caches
+from django.core.exceptions import FieldDoesNotExist, PermissionDenied, ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models.constants import LOOKUP_SEP
+from django.http import StreamingHttpResponse
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.functional import cached_property
+
+from . import booking, broadcast, export, stats
+from .availability import day_start
+from .models import Appointment, Broadcast, Category, Client, DailyStats, Master, Service
+
+CURSOR_VAR = 'cursor'
+AFTER = 'a'
+BEFORE = 'b'
+
+DEFAULTS = {
+    'CACHE_ALIAS': 'default',
+    'COUNT_CACHE_TIMEOUT': 60,
+    # On PostgreSQL, counts the planner puts above this are shown as an
+    # estimate instead of being counted.
+    'ESTIMATE_ABOVE': 100000,
+}
+
+
+def _config():
+    return {**DEFAULTS, **getattr(settings, 'ADMIN_CHANGELIST', {})}
+
+
+def _estimate(queryset):
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def cached_count(queryset):
+    """``(count, is_estimate)`` for a queryset, cached for a short while."""
+    config = _config()
+    queryset = queryset.order_by().select_related(None)
+    sql, params = queryset.query.sql_with_params()
+    key = 'admin-count:' + hashlib.md5(f'{sql}|{params}'.encode()).hexdigest()
+    cache = caches[config['CACHE_ALIAS']]
+    result = cache.get(key)
+    if result is None:
+        estimate = _estimate(queryset)
+        if estimate is not None and estimate > config['ESTIMATE_ABOVE']:
+            result = (estimate, True)
+        else:
+            result = (queryset.count(), False)
+        cache.set(key, result, config['COUNT_CACHE_TIMEOUT'])
+    return result
+
+
+class CachedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        return cached_count(self.object_list)[0]
+
+
+def related_lookups(model, lookup):
+    """
+    Split the relations a ``list_display`` lookup walks into a
+    ``select_related`` path and a ``prefetch_related`` one.
+    """
+    opts, walked = model._meta, []
+    for part in lookup.split(LOOKUP_SEP):
+        try:
+            field = opts.get_field(part)
+        except FieldDoesNotExist:
+            break
+        # ``<fk>_id`` needs no join.
+        if not field.is_relation or part != field.name:
+            break
+        walked.append(part)
+        if field.many_to_many or field.one_to_many:
+            return LOOKUP_SEP.join(walked[:-1]) or None, LOOKUP_SEP.join(walked)
+        opts = field.related_model._meta
+    return LOOKUP_SEP.join(walked) or None, None
+
+
+class KeysetChangeList(ChangeList):
+    keyset = False
+    count_is_estimate = False
+
+    def get_queryset(self, request, exclude_parameters=None):
+        # The cursor is not a filter; keep it out of the lookups and of the
+        # links built from them, just like the page number.
+        if not hasattr(self, 'cursor'):
+            self.cursor = self.params.pop(CURSOR_VAR, None)
+            self.filter_params.pop(CURSOR_VAR, None)
+        return super().get_queryset(request, exclude_parameters)
+
+    @cached_property
+    def related_fields(self):
+        select, prefetch = [], list(self.model_admin.list_prefetch_related)
+        for name in self.list_display:
+            if not isinstance(name, str):
+                lookup = getattr(name, 'admin_order_field', None)
+            elif LOOKUP_SEP in name or self._is_field(name):
+                lookup = name
+            else:
+                attr = getattr(self.model_admin, name, None) or getattr(self.model, name, None)
+                lookup = getattr(attr, 'admin_order_field', None)
+            if isinstance(lookup, str):
+                joined, prefetched = related_lookups(self.model, lookup.removeprefix('-'))
+                if joined and joined not in select:
+                    select.append(joined)
+                if prefetched and prefetched not in prefetch:
+                    prefetch.append(prefetched)
+        return select, prefetch
+
+    def _is_field(self, name):
+        try:
+            self.lookup_opts.get_field(name)
+        except FieldDoesNotExist:
+            return False
+        return True
+
+    def get_select_related_fields(self):
+        return self.related_fields[0]
+
+    def apply_select_related(self, qs):
+        qs = super().apply_select_related(qs)
+        if prefetch := self.related_fields[1]:
+            qs = qs.prefetch_related(*prefetch)
+        return qs
+
+    def _keyset_order(self):
+        """The keyset field's sort direction, or ``None`` for other orderings."""
+        field = self.model_admin.keyset_field
+        # ChangeList repeats the admin ordering already on the root queryset.
+        ordering = list(dict.fromkeys(self.queryset.query.order_by))
+        if field is None or self.list_editable or len(ordering) != 2:
+            return None
+        if not all(isinstance(item, str) for item in ordering):
+            return None
+        first, second = ordering
+        descending = first.startswith('-')
+        if first.removeprefix('-') != field or second.startswith('-') != descending:
+            return None
+        if second.removeprefix('-') not in ('pk', self.lookup_opts.pk.name):
+            return None
+        return descending
+
+    def _parse_cursor(self):
+        direction, pk, value = self.cursor[:1], *self.cursor[1:].partition('_')[::2]
+        field = self.lookup_opts.get_field(self.model_admin.keyset_field)
+        try:
+            pk, value = self.lookup_opts.pk.to_python(pk), field.to_python(value)
+        except ValidationError as exc:
+            raise IncorrectLookupParameters(exc)
+        if direction not in (AFTER, BEFORE) or pk is None or value is None:
+            raise IncorrectLookupParameters(f'Invalid cursor {self.cursor!r}')
+        return direction, pk, value
+
+    def _cursor(self, direction, obj):
+        value = getattr(obj, self.model_admin.keyset_field)
+        if isinstance(value, datetime.datetime):
+            value = timezone.localtime(value) if timezone.is_aware(value) else value
+        value = value.isoformat()
+        return self.get_query_string({CURSOR_VAR: f'{direction}{obj.pk}_{value}'})
+
+    def get_results(self, request):
+        descending = self._keyset_order()
+        if descending is None or self.show_all:
+            return super().get_results(request)
+        self.keyset = True
+        self.result_count, self.count_is_estimate = cached_count(self.queryset)
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.can_show_all = False
+        self.paginator = None
+
+        qs = self.queryset
+        field = self.model_admin.keyset_field
+        direction = None
+        if self.cursor:
+            direction, pk, value = self._parse_cursor()
+            # Rows after the cursor in display order, or before it when going
+            # back (read in reverse so that the limit applies next to it).
+            older = (direction == AFTER) == descending
+            if older:
+                qs = qs.filter(**{f'{field}__lte': value}).exclude(
+                    **{field: value, 'pk__gte': pk}
+                )
+            else:
+                qs = qs.filter(**{f'{field}__gte': value}).exclude(
+                    **{field: value, 'pk__lte': pk}
+                )
+            if direction == BEFORE:
+                qs = qs.reverse()
+        rows = list(qs[:self.list_per_page + 1])
+        more = len(rows) > self.list_per_page
+        rows = rows[:self.list_per_page]
+        if direction == BEFORE:
+            rows.reverse()
+            has_previous, has_next = more, True
+        else:
+            has_previous, has_next = direction == AFTER, more
+        self.result_list = rows
+        self.multi_page = has_previous or has_next
+        self.first_page_url = self.get_query_string() if has_previous else None
+        self.previous_page_url = self._cursor(BEFORE, rows[0]) if has_previous and rows else None
+        self.next_page_url = self._cursor(AFTER, rows[-1]) if has_next and rows else None
+
+
+class KeysetModelAdmin(admin.ModelAdmin):
+    """
+    ``ModelAdmin`` for large tables.
+
+    Set ``keyset_field`` to an indexed column and order by it and the primary
+    key (``ordering = ['-start', '-id']``); other column sorts fall back to
+    numbered pages, still with the cached count.
+    """
+    keyset_field = None
+    list_prefetch_related = ()
+    show_full_result_count = False
+    change_list_template = 'admin/myapp/keyset_change_list.html'
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        return CachedCountPaginator(queryset, per_page, orphans, allow_empty_first_page)
+
+
+class AppointmentDayFilter(admin.SimpleListFilter):
+    """Date ranges that need no query, unlike ``date_hierarchy``."""
+    title = 'day'
+    parameter_name = 'day'
+
+    def lookups(self, request, model_admin):
+        return [
+            ('today', 'Today'),
+            ('tomorrow', 'Tomorrow'),
+            ('week', 'Next 7 days'),
+            ('upcoming', 'Upcoming'),
+            ('past', 'Past'),
+        ]
+
+    def queryset(self, request, queryset):
+        today = timezone.localdate()
+        start = day_start(today)
+        # Whole minutes, so that the cached count is reused between requests.
+        now = timezone.now().replace(second=0, microsecond=0)
+        ranges = {
+            'today': (start, day_start(today + datetime.timedelta(days=1))),
+            'tomorrow': (
+                day_start(today + datetime.timedelta(days=1)),
+                day_start(today + datetime.timedelta(days=2)),
+            ),
+            'week': (start, day_start(today + datetime.timedelta(days=7))),
+            'upcoming': (now, None),
+            'past': (None, now),
+        }
+        if self.value() not in ranges:
+            return None
+        first, last = ranges[self.value()]
+        if first is not None:
+            queryset = queryset.filter(start__gte=first)
+        if last is not None:
+            queryset = queryset.filter(start__lt=last)
+        return queryset
+
+
+@admin.register(Category)
+class CategoryAdmin(admin.ModelAdmin):
+    list_display = ['name', 'position']
+
+
+@admin.register(Service)
+class ServiceAdmin(admin.ModelAdmin):
+    list_display = ['name', 'category', 'price', 'duration_minutes', 'is_active']
+    list_filter = ['category', 'is_active']
+
+
+@admin.register(Master)
+class MasterAdmin(admin.ModelAdmin):
+    list_display = ['name', 'work_start', 'work_end', 'is_active']
+    filter_horizontal = ['services']
+
+
+@admin.register(Client)
+class ClientAdmin(KeysetModelAdmin):
+    list_display = ['name', 'phone', 'telegram_id', 'created_at']
+    search_fields = ['name', 'phone', 'telegram_id']
+    keyset_field = 'created_at'
+    ordering = ['-created_at', '-id']
+
+
+class AppointmentForm(forms.ModelForm):
+    class Meta:
+        model = Appointment
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        master, start, end = (cleaned_data.get(name) for name in ('master', 'start', 'end'))
+        if master is None or start is None or end is None:
+            return cleaned_data
+        if end <= start:
+            raise forms.ValidationError('The appointment must end after it starts.')
+        # The admin view saves in the same IMMEDIATE transaction, so nothing
+        # can book the interval between this check and the save.
+        if cleaned_data.get('status') in Appointment.BUSY_STATUSES and booking.overlaps(
+            master.pk, start, end, exclude=self.instance.pk
+        ):
+            raise forms.ValidationError(f'{master} already has an appointment at this time.')
+        return cleaned_data
+
+
+@admin.register(Appointment)
+class AppointmentAdmin(KeysetModelAdmin):
+    form = AppointmentForm
+    list_display = ['start', 'client', 'master', 'service', 'status']
+    list_filter = ['status', 'master', AppointmentDayFilter]
+    raw_id_fields = ['client']
+    keyset_field = 'start'
+    ordering = ['-start', '-id']
+
+
+@admin.register(Broadcast)
+class BroadcastAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'created_at', 'status', 'sent', 'blocked', 'failed', 'total']
+    readonly_fields = [
+        'status', 'started_at', 'finished_at', 'heartbeat_at', 'last_client_id', 'total', 'sent',
+        'blocked', 'failed',
+    ]
+    actions = ['start_broadcast', 'pause_broadcast']
+
+    @admin.action(permissions=['change'], description='Start or resume sending')
+    def start_broadcast(self, request, queryset):
+        for item in queryset.exclude(status=Broadcast.DONE):
+            # Running broadcasts are only taken over once their heartbeat
+            # is stale, i.e. the run crashed.
+            if broadcast.start_in_background(item.pk) is None:
+                self.message_user(request, f'{item} is already being sent.', messages.WARNING)
+            else:
+                self.message_user(request, f'Broadcast #{item.pk} is being sent.')
+
+    @admin.action(permissions=['change'], description='Pause sending')
+    def pause_broadcast(self, request, queryset):
+        paused = queryset.filter(status=Broadcast.RUNNING).update(status=Broadcast.PAUSED)
+        self.message_user(request, f'Paused {paused} broadcast(s).')
+
+
+@admin.register(DailyStats)
+class DailyStatsAdmin(admin.ModelAdmin):
+    list_display = [
+        'date', 'master', 'booked', 'completed', 'cancelled', 'no_show', 'busy_minutes', 'revenue',
+    ]
+    list_filter = ['master']
+    list_select_related = ['master']
+    date_hierarchy = 'date'
+    change_list_template = 'admin/myapp/dailystats/change_list.html'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path('report/', self.admin_site.admin_view(self.report_view), name='myapp_dailystats_report'),
+            path('export/', self.admin_site.admin_view(self.export_view), name='myapp_dailystats_export'),
+        ] + super().get_urls()
+
+    def _period(self, request):
+        last = parse_date(request.GET.get('to') or '') or timezone.localdate()
+        first = parse_date(request.GET.get('from') or '') or last - datetime.timedelta(days=29)
+        return min(first, last), last
+
+    def report_view(self, request):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        first, last = self._period(request)
+        daily = stats.daily_report(first, last)
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.opts,
+            'title': 'Revenue and occupancy',
+            'first': first,
+            'last': last,
+            'daily': daily,
+            'weekly': stats.weekly_report(daily),
+            'masters': stats.master_report(first, last),
+        }
+        return TemplateResponse(request, 'admin/myapp/dailystats/report.html', context)
+
+    def export_view(self, request):
+        # The export lists appointments with client names and phones.
+        if not (
+            self.has_view_permission(request)
+            and request.user.has_perm('myapp.view_appointment')
+        ):
+            raise PermissionDenied
+        first, last = self._period(request)
+        rows = stats.appointment_rows(first, last)
+        filename = f'appointments-{first}-{last}'
+        if request.GET.get('format') == 'xlsx':
+            response = StreamingHttpResponse(
+                export.xlsx_stream(stats.EXPORT_HEADER, rows, 'Appointments'),
+                content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            )
+            filename += '.xlsx'
+        else:
+            response = StreamingHttpResponse(
+                export.csv_stream(stats.EXPORT_HEADER, rows), content_type='text/csv; charset=utf-8'
+            )
+            filename += '.csv'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
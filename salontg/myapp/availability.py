@@ -0,0 +1,324 @@
+"""
+In-memory index of the masters' free time.
+
+Every master-day is a bitmap of 5-minute slots stored in a Python int: bit
+``i`` stands for the slot starting ``i * SLOT_MINUTES`` after local midnight.
+Free time is the working-hours mask with the busy mask cleared out, and the
+start positions that fit a service of ``k`` slots are found with a handful
+of shift-and-AND operations.  Fit masks and the per-service union over all
+masters are cached, so a repeated search is a few dict lookups.
+
+Bookings touching a master-day call ``refresh()`` for just that master-day
+(see ``myapp.signals``); changes to masters or services ``reset()`` the
+whole index, which is rebuilt with a few queries on the next search.  The
+signals only fire in the process that made the change, so a day's busy
+masks are also re-read, one query for all masters, when a search touches
+them more than ``AVAILABILITY_MAX_AGE`` seconds after they were read.
+"""
+import datetime
+import math
+import threading
+import time
+from typing import NamedTuple
+
+from django.conf import settings
+from django.utils import timezone
+
+SLOT_MINUTES = 5
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+
+
+class Slot(NamedTuple):
+    start: datetime.datetime
+    master_id: int
+
+
+def slots_for(minutes):
+    """Number of slots needed to fit ``minutes``, rounded up."""
+    return max(1, math.ceil(minutes / SLOT_MINUTES))
+
+
+def fit_mask(free, k):
+    """Bits of ``free`` that start a run of at least ``k`` set bits."""
+    covered = 1
+    while covered < k:
+        step = min(covered, k - covered)
+        free &= free >> step
+        covered += step
+    return free
+
+
+def _minute_of_day(value):
+    return value.hour * 60 + value.minute + (value.second + value.microsecond / 1e6) / 60
+
+
+def _range_mask(first, last):
+    """Mask with bits ``first`` (inclusive) to ``last`` (exclusive) set."""
+    first = max(first, 0)
+    last = min(last, SLOTS_PER_DAY)
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+
+def work_mask(work_start, work_end):
+    first = math.ceil((work_start.hour * 60 + work_start.minute) / SLOT_MINUTES)
+    last = (work_end.hour * 60 + work_end.minute) // SLOT_MINUTES
+    return _range_mask(first, last)
+
+
+def day_start(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time()))
+
+
+def interval_masks(start, end):
+    """Yield ``(day, mask)`` for every local day the interval overlaps."""
+    start = timezone.localtime(start)
+    end = timezone.localtime(end)
+    day = start.date()
+    while True:
+        first = 0 if day > start.date() else int(_minute_of_day(start)) // SLOT_MINUTES
+        if day < end.date():
+            last = SLOTS_PER_DAY
+        else:
+            last = math.ceil(_minute_of_day(end) / SLOT_MINUTES)
+        mask = _range_mask(first, last)
+        if mask:
+            yield day, mask
+        if day >= end.date():
+            break
+        day += datetime.timedelta(days=1)
+
+
+class AvailabilityIndex:
+    def __init__(self, horizon_days=None, max_age=None):
+        if horizon_days is None:
+            horizon_days = getattr(settings, 'BOOKING_HORIZON_DAYS', 14)
+        if max_age is None:
+            max_age = getattr(settings, 'AVAILABILITY_MAX_AGE', 60)
+        self.horizon_days = horizon_days
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self._loaded = False
+        # master_id -> (working-hours mask, frozenset of service ids)
+        self._masters = {}
+        # service_id -> slots needed, service_id -> tuple of master ids
+        self._service_slots = {}
+        self._service_masters = {}
+        # (master_id, day) -> busy mask, for days in [_from_day, _until_day)
+        self._busy = {}
+        self._from_day = None
+        self._until_day = None
+        # day -> time.monotonic() when its busy masks were read for all masters
+        self._read_at = {}
+        # Derived caches, dropped per master-day on refresh.
+        self._fit = {}
+        self._union = {}
+
+    def reset(self):
+        """Forget everything; the next search reloads from the database."""
+        with self._lock:
+            self._clear()
+
+    def _load(self):
+        from .models import Master, Service
+
+        services = dict(
+            Service.objects.filter(is_active=True).values_list('id', 'duration_minutes')
+        )
+        masters = {
+            pk: [work_mask(start, end), set()]
+            for pk, start, end in Master.objects.filter(is_active=True).values_list(
+                'id', 'work_start', 'work_end'
+            )
+        }
+        links = Master.services.through.objects.values_list('master_id', 'service_id')
+        service_masters = {}
+        for master_id, service_id in links:
+            if master_id in masters and service_id in services:
+                masters[master_id][1].add(service_id)
+                service_masters.setdefault(service_id, []).append(master_id)
+
+        self._masters = {pk: (mask, frozenset(ids)) for pk, (mask, ids) in masters.items()}
+        self._service_slots = {pk: slots_for(minutes) for pk, minutes in services.items()}
+        self._service_masters = {pk: tuple(sorted(ids)) for pk, ids in service_masters.items()}
+        self._loaded = True
+
+    def _busy_rows(self, first_day, last_day, master_id=None):
+        from .models import Appointment
+
+        qs = Appointment.objects.filter(
+            status__in=Appointment.BUSY_STATUSES,
+            start__lt=day_start(last_day),
+            end__gt=day_start(first_day),
+        )
+        if master_id is not None:
+            qs = qs.filter(master_id=master_id)
+        return qs.values_list('master_id', 'start', 'end')
+
+    def _mark(self, busy, rows, first_day, last_day):
+        for master_id, start, end in rows:
+            for day, mask in interval_masks(start, end):
+                if first_day <= day < last_day:
+                    key = (master_id, day)
+                    busy[key] = busy.get(key, 0) | mask
+
+    def _read_days(self, first_day, last_day):
+        self._mark(self._busy, self._busy_rows(first_day, last_day), first_day, last_day)
+        now = time.monotonic()
+        day = first_day
+        while day < last_day:
+            self._read_at[day] = now
+            day += datetime.timedelta(days=1)
+
+    def _ensure_window(self, today, days):
+        if not self._loaded:
+            self._load()
+        until = today + datetime.timedelta(days=days)
+        if self._from_day is None or self._from_day > today:
+            self._busy.clear()
+            self._read_at.clear()
+            self._fit.clear()
+            self._union.clear()
+            self._read_days(today, until)
+            self._from_day, self._until_day = today, until
+            return
+        if self._from_day < today:
+            # The day rolled over: drop what is now in the past.
+            for cache in (self._busy, self._fit, self._union):
+                for key in [key for key in cache if key[1] < today]:
+                    del cache[key]
+            for day in [day for day in self._read_at if day < today]:
+                del self._read_at[day]
+            self._from_day = today
+        if self._until_day < until:
+            self._read_days(self._until_day, until)
+            self._until_day = until
+
+    def _ensure_fresh(self, day):
+        """Re-read ``day`` if it may have missed changes made by other processes."""
+        if time.monotonic() - self._read_at.get(day, 0) <= self.max_age:
+            return
+        for key in [key for key in self._busy if key[1] == day]:
+            del self._busy[key]
+        self._read_days(day, day + datetime.timedelta(days=1))
+        for master_id in self._masters:
+            self._invalidate(master_id, day)
+
+    def refresh(self, master_days):
+        """Reload the busy masks of the given ``(master_id, day)`` pairs."""
+        with self._lock:
+            if not self._loaded or self._from_day is None:
+                return
+            for master_id, day in set(master_days):
+                if not self._from_day <= day < self._until_day:
+                    continue
+                next_day = day + datetime.timedelta(days=1)
+                busy = {}
+                self._mark(busy, self._busy_rows(day, next_day, master_id), day, next_day)
+                self._busy.pop((master_id, day), None)
+                self._busy.update(busy)
+                self._invalidate(master_id, day)
+
+    def _invalidate(self, master_id, day):
+        for k in set(self._service_slots.values()):
+            self._fit.pop((master_id, day, k), None)
+        master = self._masters.get(master_id)
+        if master is not None:
+            for service_id in master[1]:
+                self._union.pop((service_id, day), None)
+
+    def _fit_mask(self, master_id, day, k):
+        key = (master_id, day, k)
+        mask = self._fit.get(key)
+        if mask is None:
+            free = self._masters[master_id][0] & ~self._busy.get((master_id, day), 0)
+            mask = self._fit[key] = fit_mask(free, k)
+        return mask
+
+    def _union_mask(self, service_id, day, k):
+        key = (service_id, day)
+        mask = self._union.get(key)
+        if mask is None:
+            mask = 0
+            for master_id in self._service_masters.get(service_id, ()):
+                mask |= self._fit_mask(master_id, day, k)
+            self._union[key] = mask
+        return mask
+
+    def find_free_slots(self, service_id, count=5, days=None, now=None, master_id=None):
+        """
+        Return up to ``count`` earliest ``Slot``s where ``service_id`` fits,
+        looking ``days`` days ahead (the index horizon by default).  Pass
+        ``master_id`` to restrict the search to one master.
+        """
+        if days is None:
+            days = self.horizon_days
+        now = timezone.localtime(now)
+        today = now.date()
+        cutoff = math.ceil(_minute_of_day(now) / SLOT_MINUTES)
+        results = []
+        with self._lock:
+            self._ensure_window(today, days)
+            k = self._service_slots.get(service_id)
+            if k is None:
+                return results
+            masters = self._service_masters.get(service_id, ())
+            if master_id is not None:
+                masters = (master_id,) if master_id in masters else ()
+            for offset in range(days):
+                day = today + datetime.timedelta(days=offset)
+                self._ensure_fresh(day)
+                if master_id is None:
+                    mask = self._union_mask(service_id, day, k)
+                else:
+                    mask = self._fit_mask(master_id, day, k) if masters else 0
+                if offset == 0:
+                    mask &= ~((1 << cutoff) - 1)
+                while mask:
+                    low = mask & -mask
+                    mask ^= low
+                    i = low.bit_length() - 1
+                    found = next(m for m in masters if self._fit_mask(m, day, k) >> i & 1)
+                    results.append(Slot(self._slot_start(day, i), found))
+                    if len(results) >= count:
+                        return results
+        return results
+
+    def is_free(self, master_id, service_id, start):
+        """Whether ``master_id`` can take ``service_id`` starting at ``start``."""
+        start = timezone.localtime(start)
+        minute = _minute_of_day(start)
+        if minute % SLOT_MINUTES:
+            return False
+        today = timezone.localdate()
+        day = start.date()
+        if not today <= day < today + datetime.timedelta(days=self.horizon_days):
+            return False
+        with self._lock:
+            self._ensure_window(today, self.horizon_days)
+            k = self._service_slots.get(service_id)
+            if k is None or master_id not in self._service_masters.get(service_id, ()):
+                return False
+            self._ensure_fresh(day)
+            return bool(self._fit_mask(master_id, day, k) >> (int(minute) // SLOT_MINUTES) & 1)
+
+    @staticmethod
+    def _slot_start(day, i):
+        return timezone.make_aware(
+            datetime.datetime.combine(day, datetime.time())
+            + datetime.timedelta(minutes=i * SLOT_MINUTES)
+        )
+
+
+index = AvailabilityIndex()
+
+
+def find_free_slots(service, count=5, days=None, now=None, master=None):
+    """Earliest free slots for ``service`` (a ``Service`` or its pk)."""
+    service_id = getattr(service, 'pk', service)
+    master_id = getattr(master, 'pk', master)
+    return index.find_free_slots(service_id, count=count, days=days, now=now, master_id=master_id)
@@ -0,0 +1,273 @@
+"""
+Single-writer path for appointment changes.
+
+SQLite allows one writer at a time, and concurrent booking transactions either
+fail with "database is locked" or, when the conflict check and the insert run
+in separate transactions, book the same slot twice.  Every booking, move and
+cancellation therefore goes through ``BookingWriter``: callers enqueue an
+operation and wait on a future while a single thread drains the queue and
+applies operations in batches, one transaction per batch.  The overlap check
+and the write share a transaction, so a conflicting request simply gets
+``SLOT_TAKEN`` back.  The admin is the only other writer: its add/change
+view runs the same ``overlaps()`` check in the form, inside the view's
+transaction, which with ``transaction_mode: IMMEDIATE`` holds SQLite's write
+lock from the start and so is serialized with the writer.  Requests for a time
+that has passed, falls outside the master's hours, or a master who is
+inactive or does not offer the service get ``INVALID``, as do unknown
+statuses.  Status changes that make an appointment busy again (for example
+re-activating a cancelled one) are checked for overlaps like a booking.
+
+Reads are unaffected: with WAL journaling (see ``DATABASES`` in settings)
+readers keep running while the writer commits.
+"""
+import asyncio
+import datetime
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from .models import Appointment, Master, Service
+
+logger = logging.getLogger(__name__)
+
+BOOKED = 'booked'
+MOVED = 'moved'
+CANCELLED = 'cancelled'
+SLOT_TAKEN = 'slot_taken'
+NOT_FOUND = 'not_found'
+INVALID = 'invalid'
+
+_STOP = object()
+
+
+class BookingResult(NamedTuple):
+    status: str
+    appointment: Appointment = None
+
+    @property
+    def ok(self):
+        return self.status not in (SLOT_TAKEN, NOT_FOUND, INVALID)
+
+
+def overlaps(master_id, start, end, exclude=None):
+    """Whether the master has a busy appointment intersecting the interval."""
+    qs = Appointment.objects.filter(
+        master_id=master_id,
+        status__in=Appointment.BUSY_STATUSES,
+        start__lt=end,
+        end__gt=start,
+    )
+    if exclude is not None:
+        qs = qs.exclude(pk=exclude)
+    return qs.exists()
+
+
+def _bookable(master_id, service_id, start, end):
+    """Whether the master works at that time and offers the service."""
+    if start < timezone.now():
+        return False
+    master = (
+        Master.objects.filter(
+            pk=master_id, is_active=True, services=service_id, services__is_active=True
+        )
+        .only('work_start', 'work_end')
+        .first()
+    )
+    if master is None:
+        return False
+    start, end = timezone.localtime(start), timezone.localtime(end)
+    return (
+        start.date() == end.date()
+        and master.work_start <= start.time()
+        and end.time() <= master.work_end
+    )
+
+
+def _book(client_id, master_id, service_id, start):
+    service = Service.objects.only('duration_minutes', 'price').filter(pk=service_id).first()
+    if service is None:
+        return BookingResult(INVALID)
+    end = start + datetime.timedelta(minutes=service.duration_minutes)
+    if not _bookable(master_id, service_id, start, end):
+        return BookingResult(INVALID)
+    if overlaps(master_id, start, end):
+        return BookingResult(SLOT_TAKEN)
+    appointment = Appointment.objects.create(
+        client_id=client_id,
+        master_id=master_id,
+        service=service,
+        start=start,
+        end=end,
+        price=service.price,
+    )
+    return BookingResult(BOOKED, appointment)
+
+
+def _move(appointment_id, start, master_id):
+    appointment = Appointment.objects.select_related('service').filter(pk=appointment_id).first()
+    if appointment is None or appointment.status != Appointment.BOOKED:
+        return BookingResult(NOT_FOUND)
+    master_id = master_id or appointment.master_id
+    end = start + datetime.timedelta(minutes=appointment.service.duration_minutes)
+    if not _bookable(master_id, appointment.service_id, start, end):
+        return BookingResult(INVALID, appointment)
+    if overlaps(master_id, start, end, exclude=appointment.pk):
+        return BookingResult(SLOT_TAKEN, appointment)
+    appointment.master_id = master_id
+    appointment.start = start
+    appointment.end = end
+    appointment.save(update_fields=['master', 'start', 'end'])
+    return BookingResult(MOVED, appointment)
+
+
+def _set_status(appointment_id, status, only_from=None):
+    if status not in dict(Appointment.STATUS_CHOICES):
+        return BookingResult(INVALID)
+    appointment = Appointment.objects.filter(pk=appointment_id).first()
+    if appointment is None or only_from is not None and appointment.status != only_from:
+        return BookingResult(NOT_FOUND)
+    if status in Appointment.BUSY_STATUSES and not appointment.is_busy and overlaps(
+        appointment.master_id, appointment.start, appointment.end, exclude=appointment.pk
+    ):
+        return BookingResult(SLOT_TAKEN, appointment)
+    appointment.status = status
+    appointment.save(update_fields=['status'])
+    return BookingResult(status, appointment)
+
+
+class BookingWriter:
+    def __init__(self, batch_size=None, batch_delay=None):
+        config = getattr(settings, 'BOOKING_WRITER', {})
+        self.batch_size = batch_size or config.get('BATCH_SIZE', 200)
+        if batch_delay is None:
+            batch_delay = config.get('BATCH_DELAY', 0.002)
+        self.batch_delay = batch_delay
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.commits = 0
+        self.operations = 0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='booking-writer', daemon=True
+                )
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._start_lock:
+            if self._thread is not None:
+                self._queue.put(_STOP)
+                self._thread.join(timeout)
+                self._thread = None
+
+    def submit(self, func, *args):
+        """Run ``func(*args)`` on the writer thread; return a ``Future``."""
+        self.start()
+        future = Future()
+        self._queue.put((func, args, future))
+        return future
+
+    def book(self, client_id, master_id, service_id, start, timeout=None):
+        return self.submit(_book, client_id, master_id, service_id, start).result(timeout)
+
+    def move(self, appointment_id, start, master_id=None, timeout=None):
+        return self.submit(_move, appointment_id, start, master_id).result(timeout)
+
+    def cancel(self, appointment_id, timeout=None):
+        return self.submit(
+            _set_status, appointment_id, Appointment.CANCELLED, Appointment.BOOKED
+        ).result(timeout)
+
+    def set_status(self, appointment_id, status, timeout=None):
+        return self.submit(_set_status, appointment_id, status).result(timeout)
+
+    async def abook(self, client_id, master_id, service_id, start):
+        return await asyncio.wrap_future(self.submit(_book, client_id, master_id, service_id, start))
+
+    async def acancel(self, appointment_id):
+        return await asyncio.wrap_future(
+            self.submit(
+                _set_status, appointment_id, Appointment.CANCELLED, Appointment.BOOKED
+            )
+        )
+
+    def _next_batch(self, first):
+        batch = [first]
+        # Give concurrent callers a moment to join this transaction.
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                self._commit(self._next_batch(item))
+        finally:
+            connection.close()
+
+    def _commit(self, batch):
+        # Futures cancelled while queued (e.g. the awaiting task of abook()
+        # was cancelled) are skipped; the others can no longer be cancelled.
+        batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        close_old_connections()
+        outcomes = []
+        try:
+            with transaction.atomic():
+                for func, args, future in batch:
+                    try:
+                        with transaction.atomic():
+                            outcomes.append((future, func(*args), None))
+                    except Exception as exc:
+                        outcomes.append((future, None, exc))
+        except Exception as exc:
+            logger.exception('Booking batch of %d operations failed to commit', len(batch))
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        self.commits += 1
+        self.operations += len(batch)
+        for future, result, exc in outcomes:
+            if exc is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exc)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BookingWriter()
+        return _writer
@@ -0,0 +1,144 @@
+"""
+Entry point for Telegram updates once they have left the webhook queue.
+
+The booking wizard walks category -> service -> master -> slot.  Each step
+reads and writes the chat's ``DialogState`` in ``myapp.state`` and renders
+screens from ``myapp.catalog`` and ``myapp.availability``, so steps do not go
+to the database; only the final booking does, through ``myapp.booking``.
+"""
+import datetime
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+
+from . import availability, booking, catalog
+from .models import Client
+from .state import get_store
+from .telegram import get_api
+
+logger = logging.getLogger(__name__)
+
+START = 'start'
+CATEGORY = 'category'
+SERVICE = 'service'
+MASTER = 'master'
+SLOT = 'slot'
+
+SLOTS_SHOWN = 8
+
+_categories_screen = sync_to_async(catalog.categories_screen)
+_services_screen = sync_to_async(catalog.services_screen)
+_masters_screen = sync_to_async(catalog.masters_screen)
+_price_list_screen = sync_to_async(catalog.price_list_screen)
+_find_free_slots = sync_to_async(availability.find_free_slots)
+_refresh_availability = sync_to_async(availability.index.refresh)
+
+
+async def handle_update(update):
+    if 'callback_query' in update:
+        await on_callback(update['callback_query'])
+    elif 'message' in update:
+        await on_message(update['message'])
+    else:
+        logger.debug('Ignoring update %s', update.get('update_id'))
+
+
+async def on_message(message):
+    chat_id = message['chat']['id']
+    if message.get('text', '').startswith('/start'):
+        store = get_store()
+        state = store.get_or_create(chat_id)
+        state.step = START
+        store.set(state)
+        screen = await _categories_screen()
+        await get_api().send_message(chat_id, screen.text, screen.reply_markup)
+
+
+async def on_callback(callback):
+    data = callback.get('data') or ''
+    message = callback.get('message') or {}
+    chat_id = message.get('chat', {}).get('id', callback['from']['id'])
+    store = get_store()
+    state = store.get_or_create(chat_id)
+    action, _, args = data.partition(':')
+
+    notice = None
+    if action == 'catalog':
+        state.step = START
+        screen = await _categories_screen()
+    elif action == 'prices':
+        screen = await _price_list_screen()
+    elif action == 'cat':
+        state.step, state.category_id = CATEGORY, int(args)
+        screen = await _services_screen(state.category_id)
+    elif action == 'svc':
+        state.step, state.service_id = SERVICE, int(args)
+        screen = await _masters_screen(state.service_id)
+    elif action == 'mst':
+        service_id, master_id = (int(value) for value in args.split(':'))
+        state.step, state.service_id, state.master_id = MASTER, service_id, master_id or None
+        screen = await slots_screen(state.service_id, state.master_id)
+    elif action == 'slot' and state.service_id:
+        screen, notice = await book_slot(callback['from'], state, *args.split(':'))
+    else:
+        logger.debug('Unknown callback %r from chat %s', data, chat_id)
+        await get_api().answer_callback(callback['id'])
+        return
+
+    store.set(state)
+    api = get_api()
+    await api.answer_callback(callback['id'], notice)
+    if 'message_id' in message:
+        await api.edit_message(chat_id, message['message_id'], screen.text, screen.reply_markup)
+    else:
+        await api.send_message(chat_id, screen.text, screen.reply_markup)
+
+
+async def slots_screen(service_id, master_id=None):
+    slots = await _find_free_slots(service_id, count=SLOTS_SHOWN, master=master_id)
+    rows = [
+        [{
+            'text': f'{timezone.localtime(slot.start):%d.%m %H:%M}',
+            'callback_data': f'slot:{int(slot.start.timestamp())}:{slot.master_id}',
+        }]
+        for slot in slots
+    ]
+    rows.append([{'text': '« Назад', 'callback_data': 'catalog'}])
+    text = 'Выберите время:' if slots else 'Свободного времени в ближайшие дни нет.'
+    return catalog.Screen(text, json.dumps({'inline_keyboard': rows}, ensure_ascii=False))
+
+
+@sync_to_async
+def _client_id(user):
+    client, _ = Client.objects.get_or_create(
+        telegram_id=user['id'],
+        defaults={'chat_id': user['id'], 'name': user.get('first_name', '')},
+    )
+    return client.pk
+
+
+async def book_slot(user, state, timestamp, master_id):
+    start = datetime.datetime.fromtimestamp(int(timestamp), tz=datetime.UTC)
+    if state.client_id is None:
+        state.client_id = await _client_id(user)
+    result = await booking.get_writer().abook(
+        state.client_id, int(master_id), state.service_id, start
+    )
+    if not result.ok:
+        # The index missed the change if another process made it.
+        await _refresh_availability([(int(master_id), timezone.localdate(start))])
+        if result.status == booking.SLOT_TAKEN:
+            return await slots_screen(state.service_id, state.master_id), 'Это время уже занято'
+        return await slots_screen(state.service_id, state.master_id), 'Это время недоступно'
+    state.step = SLOT
+    state.service_id = state.master_id = None
+    local = timezone.localtime(result.appointment.start)
+    text = f'Вы записаны на {local:%d.%m.%Y %H:%M}. До встречи!'
+    return await _categories_screen_with(text), None
+
+
+async def _categories_screen_with(text):
+    screen = await _categories_screen()
+    return catalog.Screen(text, screen.reply_markup)
@@ -0,0 +1,344 @@
+"""
+Rate-limited delivery of a ``Broadcast`` to every client.
+
+Clients are read in id order in chunks and fed to a pool of sender tasks
+sharing one pooled HTTP client, so many requests are in flight while the
+global token bucket keeps the overall rate under Telegram's limit (about 30
+messages per second) and a per-chat limiter keeps any one chat under one
+message per second.  A 429 answer pauses every sender for ``retry_after``
+seconds before the message is retried.
+
+Progress is checkpointed to the ``Broadcast`` row: ``last_client_id`` is the
+highest id below which every client has been handled, so a crashed or
+paused broadcast resumes where it stopped.  Messages in flight at the time
+of a crash may be delivered twice; nothing is skipped.
+
+A run first claims the broadcast with a single conditional UPDATE that
+stores its own token, so two admin clicks or an admin click and
+``manage.py broadcast`` cannot send it twice.  A running broadcast reports
+a heartbeat every ``HEARTBEAT_INTERVAL`` seconds; one whose heartbeat is
+older than ``STALE_AFTER`` (a crashed run) can be claimed again, and
+``force=True`` claims it regardless.  A run that finds another token on
+the row stops.
+"""
+import asyncio
+import collections
+import datetime
+import logging
+import threading
+import time
+import uuid
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, Q, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .models import Broadcast, Client
+from .telegram import BotAPI, TelegramError
+
+logger = logging.getLogger(__name__)
+
+SENT = 'sent'
+BLOCKED = 'blocked'
+FAILED = 'failed'
+
+DEFAULTS = {
+    'GLOBAL_RATE': 28,
+    'PER_CHAT_RATE': 1,
+    'CONCURRENCY': 32,
+    'CHUNK_SIZE': 1000,
+    'CHECKPOINT_EVERY': 200,
+    'MAX_ATTEMPTS': 5,
+    'HEARTBEAT_INTERVAL': 30,
+    'STALE_AFTER': 300,
+}
+
+CLAIMABLE = [Broadcast.DRAFT, Broadcast.PAUSED, Broadcast.FAILED]
+
+
+def claim(broadcast_id, force=False):
+    """
+    Mark a broadcast running on behalf of a new run and return the run's
+    token, or ``None`` if it is done or another live run owns it.
+    """
+    config = {**DEFAULTS, **getattr(settings, 'BROADCAST', {})}
+    now = timezone.now()
+    stale = now - datetime.timedelta(seconds=config['STALE_AFTER'])
+    claimable = Q(status__in=CLAIMABLE) | Q(status=Broadcast.RUNNING) & (
+        Q(heartbeat_at__isnull=True) | Q(heartbeat_at__lt=stale)
+    )
+    if force:
+        claimable |= Q(status=Broadcast.RUNNING)
+    token = uuid.uuid4().hex
+    claimed = Broadcast.objects.filter(claimable, pk=broadcast_id).update(
+        status=Broadcast.RUNNING,
+        runner=token,
+        heartbeat_at=now,
+        started_at=Coalesce(F('started_at'), Value(now)),
+    )
+    return token if claimed else None
+
+
+class TokenBucket:
+    """``rate`` tokens per second, holding at most ``capacity``."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PerChatLimiter:
+    """At most ``rate`` messages per second to any single chat."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = {}
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        ready = self._next.get(chat_id, now)
+        self._next[chat_id] = max(ready, now) + self.interval
+        if ready > now:
+            await asyncio.sleep(ready - now)
+        if len(self._next) > 10000:
+            self._next = {key: value for key, value in self._next.items() if value > now}
+
+
+class Checkpoint:
+    """Tracks the highest client id below which everything is handled."""
+
+    def __init__(self, start):
+        self.watermark = start
+        self._pending = collections.deque()
+        self._done = set()
+
+    def dispatch(self, client_id):
+        self._pending.append(client_id)
+
+    def done(self, client_id):
+        self._done.add(client_id)
+        while self._pending and self._pending[0] in self._done:
+            self.watermark = self._pending.popleft()
+            self._done.discard(self.watermark)
+
+
+class BroadcastRunner:
+    def __init__(self, broadcast_id, api=None, token=None, force=False, **options):
+        config = {**DEFAULTS, **getattr(settings, 'BROADCAST', {}), **options}
+        self.broadcast_id = broadcast_id
+        # Set when the caller already claimed the broadcast.
+        self.token = token
+        self.force = force
+        self.heartbeat_interval = config['HEARTBEAT_INTERVAL']
+        self.api = api or BotAPI(max_connections=config['CONCURRENCY'])
+        self.bucket = TokenBucket(config['GLOBAL_RATE'])
+        self.per_chat = PerChatLimiter(config['PER_CHAT_RATE'])
+        self.concurrency = config['CONCURRENCY']
+        self.chunk_size = config['CHUNK_SIZE']
+        self.checkpoint_every = config['CHECKPOINT_EVERY']
+        self.max_attempts = config['MAX_ATTEMPTS']
+        self.counts = collections.Counter()
+        self.throttled = 0
+        self._paused_until = 0.0
+        self._since_checkpoint = 0
+        self._stopped = False
+
+    async def _wait_if_paused(self):
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    async def deliver(self, chat_id, text):
+        attempt = 0
+        while attempt < self.max_attempts:
+            await self.per_chat.acquire(chat_id)
+            await self._wait_if_paused()
+            await self.bucket.acquire()
+            try:
+                await self.api.send_message(chat_id, text)
+            except TelegramError as exc:
+                if exc.status == 429:
+                    self.throttled += 1
+                    retry_after = exc.retry_after or 1
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                    # Throttling is not a failure of this message.
+                    continue
+                if exc.status == 403:
+                    return BLOCKED
+                if exc.status < 500:
+                    logger.warning('Broadcast to %s failed: %s', chat_id, exc)
+                    return FAILED
+            except httpx.HTTPError as exc:
+                logger.warning('Broadcast to %s: %s', chat_id, exc)
+            else:
+                return SENT
+            await asyncio.sleep(min(2 ** attempt, 30))
+            attempt += 1
+        return FAILED
+
+    async def _sender(self, queue, text, checkpoint):
+        while item := await queue.get():
+            client_id, chat_id = item
+            try:
+                outcome = await self.deliver(chat_id, text)
+            except Exception:
+                logger.exception('Broadcast to %s failed', chat_id)
+                outcome = FAILED
+            self.counts[outcome] += 1
+            checkpoint.done(client_id)
+            self._since_checkpoint += 1
+            queue.task_done()
+            if self._since_checkpoint >= self.checkpoint_every:
+                self._since_checkpoint = 0
+                try:
+                    await self._checkpoint(checkpoint.watermark)
+                except Exception:
+                    logger.exception('Could not checkpoint broadcast #%s', self.broadcast_id)
+        queue.task_done()
+
+    @sync_to_async
+    def _start(self):
+        if self.token is None:
+            self.token = claim(self.broadcast_id, self.force)
+            if self.token is None:
+                return None
+        broadcast = Broadcast.objects.get(pk=self.broadcast_id)
+        if broadcast.status != Broadcast.RUNNING or broadcast.runner != self.token:
+            return None
+        broadcast.total = broadcast.sent + broadcast.blocked + broadcast.failed + (
+            Client.objects.filter(pk__gt=broadcast.last_client_id).count()
+        )
+        broadcast.save(update_fields=['total'])
+        return broadcast
+
+    @sync_to_async
+    def _beat(self):
+        return Broadcast.objects.filter(
+            pk=self.broadcast_id, status=Broadcast.RUNNING, runner=self.token
+        ).update(heartbeat_at=timezone.now())
+
+    async def _heartbeat(self):
+        while not self._stopped:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                if not await self._beat():
+                    # Paused, or claimed by another run.
+                    self._stopped = True
+            except Exception:
+                logger.exception('Heartbeat of broadcast #%s failed', self.broadcast_id)
+
+    @sync_to_async
+    def _chunk(self, after):
+        return list(
+            Client.objects.filter(pk__gt=after).order_by('pk').values_list('pk', 'chat_id')[
+                :self.chunk_size
+            ]
+        )
+
+    @sync_to_async
+    def _save(self, watermark, counts, status):
+        Broadcast.objects.filter(pk=self.broadcast_id).update(
+            last_client_id=Greatest(F('last_client_id'), Value(watermark)),
+            sent=F('sent') + counts[SENT],
+            blocked=F('blocked') + counts[BLOCKED],
+            failed=F('failed') + counts[FAILED],
+        )
+        if status is not None:
+            Broadcast.objects.filter(
+                pk=self.broadcast_id, status=Broadcast.RUNNING, runner=self.token
+            ).update(status=status, finished_at=timezone.now())
+        broadcast = Broadcast.objects.get(pk=self.broadcast_id)
+        if broadcast.status != Broadcast.RUNNING or broadcast.runner != self.token:
+            # Paused from the admin or taken over; stop after the messages
+            # in flight.
+            self._stopped = True
+        return broadcast
+
+    async def _checkpoint(self, watermark, status=None):
+        counts, self.counts = self.counts, collections.Counter()
+        return await self._save(watermark, counts, status)
+
+    async def run(self):
+        broadcast = await self._start()
+        if broadcast is None:
+            return None
+        checkpoint = Checkpoint(broadcast.last_client_id)
+        queue = asyncio.Queue(self.concurrency * 2)
+        senders = [
+            asyncio.create_task(self._sender(queue, broadcast.text, checkpoint))
+            for _ in range(self.concurrency)
+        ]
+        heartbeat = asyncio.create_task(self._heartbeat())
+        status = Broadcast.FAILED
+        try:
+            after = broadcast.last_client_id
+            while not self._stopped and (chunk := await self._chunk(after)):
+                for client_id, chat_id in chunk:
+                    if self._stopped:
+                        break
+                    checkpoint.dispatch(client_id)
+                    await queue.put((client_id, chat_id))
+                after = chunk[-1][0]
+            await queue.join()
+            # Let the senders finish their last checkpoint and exit.
+            for _ in senders:
+                queue.put_nowait(None)
+            await asyncio.gather(*senders)
+            status = Broadcast.DONE if not self._stopped else None
+        finally:
+            heartbeat.cancel()
+            for sender in senders:
+                sender.cancel()
+            await asyncio.gather(heartbeat, *senders, return_exceptions=True)
+            broadcast = await self._checkpoint(checkpoint.watermark, status)
+        return broadcast
+
+
+def run_broadcast(broadcast_id, **options):
+    """Run a broadcast to completion in a fresh event loop."""
+    runner = BroadcastRunner(broadcast_id, **options)
+
+    async def main():
+        try:
+            return await runner.run()
+        finally:
+            await runner.api.aclose()
+
+    return asyncio.run(main())
+
+
+def start_in_background(broadcast_id, force=False):
+    """Claim a broadcast and send it from a thread; ``None`` if not claimed."""
+    token = claim(broadcast_id, force)
+    if token is None:
+        return None
+
+    def target():
+        try:
+            run_broadcast(broadcast_id, token=token)
+        except Exception:
+            logger.exception('Broadcast #%s crashed', broadcast_id)
+        finally:
+            close_old_connections()
+
+    thread = threading.Thread(target=target, name=f'broadcast-{broadcast_id}', daemon=True)
+    thread.start()
+    return thread
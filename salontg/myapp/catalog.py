@@ -0,0 +1,215 @@
+"""
+Read-through cache for the catalog and price screens.
+
+Screens are rendered once into ``Screen`` tuples holding the message text and
+the JSON-encoded inline keyboard, so a cache hit hands back ready-to-send
+payloads without touching the database or the JSON encoder.
+
+Entries live in a per-process LRU with a TTL.  Every entry remembers the
+versions of the namespaces it was built from; saving or deleting a model
+bumps its namespace (see ``myapp.signals``) and older entries stop matching.
+The counters are kept in Django's cache so that other processes notice a
+bump too; they re-read them at most every ``VERSION_CHECK_INTERVAL`` seconds.
+Versions never go down: a counter that was evicted (or reads lower than one
+seen before) may have lost bumps, so it is re-seeded above the last known
+value, which invalidates everything built so far.
+"""
+import collections
+import json
+import threading
+import time
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+CATALOG = 'catalog'
+MASTERS = 'masters'
+
+DEFAULTS = {
+    'CACHE_ALIAS': 'default',
+    'MAX_ENTRIES': 512,
+    'TTL': 600,
+    'VERSION_CHECK_INTERVAL': 1.0,
+}
+
+
+class Screen(NamedTuple):
+    text: str
+    reply_markup: str
+
+
+class VersionedCache:
+    def __init__(self, cache_alias='default', max_entries=512, ttl=600, version_check_interval=1.0):
+        self.cache_alias = cache_alias
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self._entries = collections.OrderedDict()
+        self._versions = {}
+        self._checked_at = float('-inf')
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_settings(cls):
+        config = {**DEFAULTS, **getattr(settings, 'CATALOG_CACHE', {})}
+        return cls(
+            cache_alias=config['CACHE_ALIAS'],
+            max_entries=config['MAX_ENTRIES'],
+            ttl=config['TTL'],
+            version_check_interval=config['VERSION_CHECK_INTERVAL'],
+        )
+
+    @property
+    def _shared(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def _version_key(namespace):
+        return f'myapp:version:{namespace}'
+
+    def _current_versions(self, namespaces):
+        now = time.monotonic()
+        if now - self._checked_at > self.version_check_interval:
+            keys = {self._version_key(namespace): namespace for namespace in (CATALOG, MASTERS)}
+            found = self._shared.get_many(keys)
+            for key, namespace in keys.items():
+                known = self._versions.get(namespace, 0)
+                version = found.get(key)
+                if version is None or version < known:
+                    version = known + 1
+                    self._shared.set(key, version, timeout=None)
+                self._versions[namespace] = version
+            self._checked_at = now
+        return tuple(self._versions.get(namespace, 0) for namespace in namespaces)
+
+    def bump(self, namespace):
+        key = self._version_key(namespace)
+        self._shared.add(key, 0, timeout=None)
+        try:
+            version = self._shared.incr(key)
+        except ValueError:
+            # The counter was evicted between add() and incr().
+            version = None
+        with self._lock:
+            known = self._versions.get(namespace, 0)
+            if version is None or version <= known:
+                # Re-created after an eviction; move it past what we know.
+                version = known + 1
+                self._shared.set(key, version, timeout=None)
+            self._versions[namespace] = version
+
+    def get_or_build(self, key, namespaces, build):
+        """Return the cached value for ``key``, calling ``build()`` on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            versions = self._current_versions(namespaces)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == versions and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        value = build()
+        with self._lock:
+            self._entries[key] = (versions, now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._checked_at = float('-inf')
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 4) if total else None,
+        }
+
+
+cache = VersionedCache.from_settings()
+
+
+def _keyboard(rows):
+    return json.dumps({'inline_keyboard': rows}, ensure_ascii=False, separators=(',', ':'))
+
+
+def _button(text, data):
+    return [{'text': text, 'callback_data': data}]
+
+
+def _price(value):
+    return f'{value.normalize():f} ₽'
+
+
+def _build_categories():
+    from .models import Category
+
+    rows = [
+        _button(category.name, f'cat:{category.pk}')
+        for category in Category.objects.filter(services__is_active=True).distinct()
+    ]
+    rows.append(_button('Прайс-лист', 'prices'))
+    return Screen('Выберите категорию услуг:', _keyboard(rows))
+
+
+def _build_services(category_id):
+    from .models import Service
+
+    services = Service.objects.filter(category_id=category_id, is_active=True)
+    rows = [
+        _button(f'{service.name} — {_price(service.price)}', f'svc:{service.pk}')
+        for service in services
+    ]
+    rows.append(_button('« Назад', 'catalog'))
+    return Screen('Выберите услугу:', _keyboard(rows))
+
+
+def _build_masters(service_id):
+    from .models import Master
+
+    masters = Master.objects.filter(services=service_id, is_active=True)
+    rows = [_button('Любой мастер', f'mst:{service_id}:0')]
+    rows += [_button(master.name, f'mst:{service_id}:{master.pk}') for master in masters]
+    rows.append(_button('« Назад', 'catalog'))
+    return Screen('Выберите мастера:', _keyboard(rows))
+
+
+def _build_prices():
+    from .models import Service
+
+    lines = []
+    category = None
+    for service in Service.objects.filter(is_active=True).select_related('category'):
+        if service.category != category:
+            category = service.category
+            lines.append(f'\n{category.name}')
+        lines.append(f'• {service.name} — {_price(service.price)}')
+    text = 'Прайс-лист:\n' + '\n'.join(lines)
+    return Screen(text, _keyboard([_button('« Назад', 'catalog')]))
+
+
+def categories_screen():
+    return cache.get_or_build('categories', (CATALOG,), _build_categories)
+
+
+def services_screen(category_id):
+    return cache.get_or_build(('services', category_id), (CATALOG,), lambda: _build_services(category_id))
+
+
+def masters_screen(service_id):
+    return cache.get_or_build(
+        ('masters', service_id), (CATALOG, MASTERS), lambda: _build_masters(service_id)
+    )
+
+
+def price_list_screen():
+    return cache.get_or_build('prices', (CATALOG,), _build_prices)
@@ -0,0 +1,128 @@
+"""
+Local stand-in for the Telegram Bot API.
+
+Serves ``POST /bot<token>/<method>`` over HTTP/1.1 keep-alive and enforces
+the same limits as Telegram: answers 429 with ``retry_after`` once more than
+``rate_limit`` messages were sent in the last second, or when a chat gets a
+second message within ``1 / per_chat_limit`` seconds.  Every accepted message
+is recorded, so tests and ``manage.py fake_bot_api`` can check throughput and
+limit compliance without touching the real API.
+"""
+import asyncio
+import collections
+import json
+import time
+
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 429: 'Too Many Requests'}
+
+
+class FakeBotServer:
+    def __init__(self, rate_limit=30, per_chat_limit=1, retry_after=1, blocked=(), latency=0.0):
+        self.rate_limit = rate_limit
+        self.per_chat_limit = per_chat_limit
+        self.retry_after = retry_after
+        self.blocked = set(blocked)
+        self.latency = latency
+        self.messages = []
+        self.throttled = 0
+        self._window = collections.deque()
+        self._last_by_chat = {}
+        self._server = None
+        self.port = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def _serve(self, reader, writer):
+        try:
+            while request_line := await reader.readline():
+                path = request_line.split()[1].decode()
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                status, payload = self.dispatch(path, body)
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                writer.write(
+                    f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                    f'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(data)}\r\n\r\n'.encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def dispatch(self, path, body):
+        method = path.rstrip('/').rsplit('/', 1)[-1]
+        try:
+            params = json.loads(body or b'{}')
+        except ValueError:
+            return 400, self._error(400, 'Bad Request: invalid JSON')
+        if method == 'sendMessage':
+            return self.send_message(params)
+        if method in ('answerCallbackQuery', 'editMessageText', 'getMe'):
+            return 200, {'ok': True, 'result': True}
+        return 404, self._error(404, 'Not Found')
+
+    @staticmethod
+    def _error(code, description, **parameters):
+        payload = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            payload['parameters'] = parameters
+        return payload
+
+    def send_message(self, params):
+        now = time.monotonic()
+        chat_id = params.get('chat_id')
+        window = self._window
+        while window and window[0] <= now - 1:
+            window.popleft()
+        last = self._last_by_chat.get(chat_id)
+        if len(window) >= self.rate_limit or (
+            last is not None and now - last < 1 / self.per_chat_limit
+        ):
+            self.throttled += 1
+            return 429, self._error(
+                429, f'Too Many Requests: retry after {self.retry_after}',
+                retry_after=self.retry_after,
+            )
+        if chat_id in self.blocked:
+            return 403, self._error(403, 'Forbidden: bot was blocked by the user')
+        window.append(now)
+        self._last_by_chat[chat_id] = now
+        self.messages.append((now, chat_id, params.get('text')))
+        return 200, {
+            'ok': True,
+            'result': {'message_id': len(self.messages), 'chat': {'id': chat_id}},
+        }
+
+    def peak_rate(self):
+        """Most messages accepted within any one-second window."""
+        times = [sent_at for sent_at, _, _ in self.messages]
+        peak = first = 0
+        for last, sent_at in enumerate(times):
+            while times[first] <= sent_at - 1:
+                first += 1
+            peak = max(peak, last - first + 1)
+        return peak
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.broadcast import run_broadcast
+from myapp.models import Broadcast
+
+
+class Command(BaseCommand):
+    help = 'Send a broadcast to every client, or resume an interrupted one.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('broadcast_id', nargs='?', type=int, help='Broadcast to start or resume.')
+        parser.add_argument('--text', help='Create a new broadcast with this text and send it.')
+        parser.add_argument('--rate', type=float, help='Messages per second (BROADCAST["GLOBAL_RATE"]).')
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Take over a broadcast marked running even if its heartbeat is recent.',
+        )
+
+    def handle(self, *args, broadcast_id, text, rate, force, **options):
+        if (broadcast_id is None) == (text is None):
+            raise CommandError('Pass either a broadcast id or --text.')
+        if text is not None:
+            broadcast_id = Broadcast.objects.create(text=text).pk
+        elif not Broadcast.objects.filter(pk=broadcast_id).exists():
+            raise CommandError(f'Broadcast #{broadcast_id} does not exist.')
+        options = {'GLOBAL_RATE': rate} if rate else {}
+        broadcast = run_broadcast(broadcast_id, force=force, **options)
+        if broadcast is None:
+            raise CommandError(
+                f'Broadcast #{broadcast_id} has already been sent or is being sent '
+                '(use --force to take over a run that is stuck).'
+            )
+        self.stdout.write(
+            f'{broadcast}: {broadcast.sent} sent, {broadcast.blocked} blocked, '
+            f'{broadcast.failed} failed of {broadcast.total}.'
+        )
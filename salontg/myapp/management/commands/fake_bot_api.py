@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from myapp.fakebot import FakeBotServer
+
+
+class Command(BaseCommand):
+    help = (
+        'Run a local fake Telegram Bot API for offline broadcast tests; point '
+        'TELEGRAM_API_URL at it.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument('--rate-limit', type=int, default=30, help='Messages per second.')
+        parser.add_argument('--latency', type=float, default=0.05, help='Seconds per request.')
+
+    def handle(self, *args, port, rate_limit, latency, **options):
+        asyncio.run(self.serve(port, rate_limit, latency))
+
+    async def serve(self, port, rate_limit, latency):
+        server = FakeBotServer(rate_limit=rate_limit, latency=latency)
+        await server.start(port=port)
+        self.stdout.write(f'Fake Bot API listening on {server.url}')
+        reported = 0
+        try:
+            while True:
+                await asyncio.sleep(5)
+                if len(server.messages) != reported:
+                    reported = len(server.messages)
+                    recent = sum(1 for sent_at, *_ in server.messages if sent_at > time.monotonic() - 5)
+                    self.stdout.write(
+                        f'{reported} messages, {recent / 5:.1f}/s now, peak {server.peak_rate()}/s, '
+                        f'{server.throttled} throttled'
+                    )
+        finally:
+            await server.stop()
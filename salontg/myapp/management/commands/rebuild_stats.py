@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from myapp import stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily occupancy and revenue aggregates from the appointments.'
+
+    def handle(self, *args, **options):
+        rows = stats.rebuild()
+        self.stdout.write(f'Rebuilt {rows} daily stats row(s).')
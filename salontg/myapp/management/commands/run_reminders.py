@@ -0,0 +1,35 @@
+import asyncio
+import signal
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+
+from myapp.reminders import ReminderScheduler
+
+
+class Command(BaseCommand):
+    help = 'Send appointment reminders and feedback requests as they come due.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Send whatever is due now (including missed reminders) and exit.',
+        )
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options['once']))
+
+    async def run(self, once):
+        scheduler = ReminderScheduler()
+        if once:
+            await sync_to_async(scheduler.load)()
+            sent = await scheduler.run_pending()
+            self.stdout.write(f'Sent {sent} reminder(s).')
+            return
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        await scheduler.run(stop)
+        self.stdout.write(f'Stopped after sending {scheduler.sent} reminder(s).')
@@ -0,0 +1,32 @@
+# Generated by Django 6.1.2 on 2026-10-18 05:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.CreateModel(
+            name='ReminderLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('24h', '24 hours before'), ('2h', '2 hours before'), ('feedback', 'Feedback request')], max_length=16)),
+                ('appointment_start', models.DateTimeField()),
+                ('sent_at', models.DateTimeField(auto_now_add=True)),
+                ('appointment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reminders', to='myapp.appointment')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('appointment', 'kind', 'appointment_start'), name='unique_reminder')],
+            },
+        ),
+    ]
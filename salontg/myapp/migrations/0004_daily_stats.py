@@ -0,0 +1,32 @@
+# Generated by Django 6.1.2 on 2026-10-18 05:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0003_broadcast'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('booked', models.IntegerField(default=0)),
+                ('completed', models.IntegerField(default=0)),
+                ('cancelled', models.IntegerField(default=0)),
+                ('no_show', models.IntegerField(default=0)),
+                ('busy_minutes', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('master', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='myapp.master')),
+            ],
+            options={
+                'verbose_name_plural': 'daily stats',
+                'constraints': [models.UniqueConstraint(fields=('date', 'master'), name='unique_daily_stats')],
+            },
+        ),
+    ]
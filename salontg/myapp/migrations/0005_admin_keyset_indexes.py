@@ -0,0 +1,25 @@
+# Generated by Django 6.1.2 on 2026-10-18 05:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0004_daily_stats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['start', 'id'], name='myapp_appoi_start_0507b1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['status', 'start', 'id'], name='myapp_appoi_status_e115ce_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='client',
+            index=models.Index(fields=['created_at', 'id'], name='myapp_clien_created_fe279d_idx'),
+        ),
+    ]
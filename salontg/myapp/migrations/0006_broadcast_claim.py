@@ -0,0 +1,23 @@
+# Generated by Django 6.1.2 on 2026-10-18 06:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0005_admin_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcast',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='broadcast',
+            name='runner',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+    ]
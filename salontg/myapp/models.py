@@ -1,3 +1,220 @@
+import datetime
+
 from django.db import models
 
-# Create your models here.
+
+class Category(models.Model):
+    name = models.CharField(max_length=100)
+    position = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        ordering = ['position', 'name']
+        verbose_name_plural = 'categories'
+
+    def __str__(self):
+        return self.name
+
+
+class Service(models.Model):
+    category = models.ForeignKey(Category, on_delete=models.PROTECT, related_name='services')
+    name = models.CharField(max_length=200)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    duration_minutes = models.PositiveSmallIntegerField(default=60)
+    is_active = models.BooleanField(default=True)
+
+    class Meta:
+        ordering = ['category', 'name']
+
+    def __str__(self):
+        return self.name
+
+
+class Master(models.Model):
+    name = models.CharField(max_length=200)
+    services = models.ManyToManyField(Service, related_name='masters', blank=True)
+    work_start = models.TimeField(default=datetime.time(10, 0))
+    work_end = models.TimeField(default=datetime.time(20, 0))
+    is_active = models.BooleanField(default=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+class Client(models.Model):
+    telegram_id = models.BigIntegerField(unique=True)
+    chat_id = models.BigIntegerField()
+    name = models.CharField(max_length=200, blank=True)
+    phone = models.CharField(max_length=32, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id']),
+        ]
+
+    def __str__(self):
+        return self.name or str(self.telegram_id)
+
+
+class Appointment(models.Model):
+    BOOKED = 'booked'
+    COMPLETED = 'completed'
+    CANCELLED = 'cancelled'
+    NO_SHOW = 'no_show'
+    STATUS_CHOICES = [
+        (BOOKED, 'Booked'),
+        (COMPLETED, 'Completed'),
+        (CANCELLED, 'Cancelled'),
+        (NO_SHOW, 'No-show'),
+    ]
+    # Statuses that keep the master busy for the appointment's interval.
+    BUSY_STATUSES = (BOOKED, COMPLETED)
+
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, related_name='appointments')
+    master = models.ForeignKey(Master, on_delete=models.PROTECT, related_name='appointments')
+    service = models.ForeignKey(Service, on_delete=models.PROTECT, related_name='appointments')
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=BOOKED)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Lets out-of-process consumers (the reminder scheduler) pick up changes
+    # without scanning every future appointment.
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['master', 'start']),
+            # Keyset pagination of the admin changelist, unfiltered and
+            # filtered by status.
+            models.Index(fields=['start', 'id']),
+            models.Index(fields=['status', 'start', 'id']),
+        ]
+
+    def __str__(self):
+        return f'{self.client} - {self.service} ({self.start:%Y-%m-%d %H:%M})'
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_state()
+        return instance
+
+    def _remember_state(self):
+        # Snapshot of the persisted row, used by signal handlers to find out
+        # which master-days a save has vacated.
+        self._original = {
+            'master_id': self.__dict__.get('master_id'),
+            'start': self.__dict__.get('start'),
+            'end': self.__dict__.get('end'),
+            'price': self.__dict__.get('price'),
+            'status': self.__dict__.get('status'),
+        }
+
+    @property
+    def original(self):
+        return getattr(self, '_original', None)
+
+    def save(self, *args, **kwargs):
+        if self.end is None and self.start is not None:
+            self.end = self.start + datetime.timedelta(minutes=self.service.duration_minutes)
+        if self.price is None:
+            self.price = self.service.price
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'updated_at'}
+        super().save(*args, **kwargs)
+        self._remember_state()
+
+    @property
+    def is_busy(self):
+        return self.status in self.BUSY_STATUSES
+
+
+class ReminderLog(models.Model):
+    REMIND_24H = '24h'
+    REMIND_2H = '2h'
+    FEEDBACK = 'feedback'
+    KIND_CHOICES = [
+        (REMIND_24H, '24 hours before'),
+        (REMIND_2H, '2 hours before'),
+        (FEEDBACK, 'Feedback request'),
+    ]
+
+    appointment = models.ForeignKey(Appointment, on_delete=models.CASCADE, related_name='reminders')
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    # The appointment time the reminder was about; a moved appointment gets
+    # fresh reminders.
+    appointment_start = models.DateTimeField()
+    sent_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['appointment', 'kind', 'appointment_start'], name='unique_reminder',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.get_kind_display()} for #{self.appointment_id}'
+
+
+class Broadcast(models.Model):
+    DRAFT = 'draft'
+    RUNNING = 'running'
+    PAUSED = 'paused'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (DRAFT, 'Draft'),
+        (RUNNING, 'Running'),
+        (PAUSED, 'Paused'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    text = models.TextField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=DRAFT)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Every client with a smaller or equal id has been handled; a resumed
+    # broadcast continues after it.
+    last_client_id = models.BigIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    blocked = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    # The run that claimed the broadcast, and when it last reported in; a
+    # running broadcast whose heartbeat went stale can be claimed again.
+    runner = models.CharField(max_length=32, blank=True, editable=False)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Broadcast #{self.pk} ({self.get_status_display()})'
+
+
+class DailyStats(models.Model):
+    """
+    Per-master, per-day appointment totals, kept up to date by
+    ``myapp.stats`` whenever an appointment changes.
+    """
+    date = models.DateField()
+    master = models.ForeignKey(Master, on_delete=models.CASCADE, related_name='daily_stats')
+    booked = models.IntegerField(default=0)
+    completed = models.IntegerField(default=0)
+    cancelled = models.IntegerField(default=0)
+    no_show = models.IntegerField(default=0)
+    busy_minutes = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = 'daily stats'
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'master'], name='unique_daily_stats'),
+        ]
+
+    def __str__(self):
+        return f'{self.master} on {self.date}'
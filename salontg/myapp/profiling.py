@@ -0,0 +1,283 @@
+"""
+Per-view request profiling.
+
+``ProfilingMiddleware`` times every request and the SQL it runs and groups
+the numbers by view: request count, wall and SQL time percentiles, queries
+per request, and how many requests ran one statement ``DUPLICATE_THRESHOLD``
+or more times, the usual sign of an N+1 loop.  Queries are attributed through
+a context variable, so those run by the ``sync_to_async`` helpers of async
+views are counted too.  Telegram updates are handled after the webhook has
+answered, so ``myapp.webhook`` records each one under ``UPDATE_VIEW``.
+
+Profiling is off unless ``PROFILING['ENABLED']`` is set.  The numbers are
+served at ``/profiling/stats/`` to staff and written as JSON to
+``PROFILING['DUMP_PATH']`` every ``DUMP_INTERVAL`` seconds and at exit.
+"""
+import atexit
+import collections
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from . import webhook
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    'DUMP_PATH': None,
+    'DUMP_INTERVAL': 60.0,
+    'DUPLICATE_THRESHOLD': 3,
+    'WINDOW': 2048,
+}
+
+UPDATE_VIEW = 'telegram:update'
+
+_current = contextvars.ContextVar('profiling_query_log', default=None)
+
+
+class QueryLog:
+    """SQL run while ``record_queries()`` is active, keyed by statement."""
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.count = 0
+        self.time = 0.0
+        self.statements = collections.Counter()
+
+    def add(self, sql, duration):
+        self.count += 1
+        self.time += duration
+        self.statements[sql] += 1
+        if self.parent is not None:
+            self.parent.add(sql, duration)
+
+    def duplicates(self, threshold):
+        """``(sql, times)`` for statements run at least ``threshold`` times."""
+        return [(sql, times) for sql, times in self.statements.most_common() if times >= threshold]
+
+
+def _execute(execute, sql, params, many, context):
+    log = _current.get()
+    if log is None:
+        return execute(sql, params, many, context)
+    began = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        log.add(sql, time.perf_counter() - began)
+
+
+def _install(connection, **kwargs):
+    if _execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute)
+
+
+# Connections are per thread; new ones (e.g. in the sync_to_async thread)
+# get the wrapper as they connect.
+connection_created.connect(_install, dispatch_uid='myapp.profiling')
+
+
+@contextlib.contextmanager
+def record_queries():
+    """Collect the SQL run in this context into a ``QueryLog``."""
+    for alias in connections:
+        _install(connections[alias])
+    # Nested logs also report to the enclosing one.
+    log = QueryLog(_current.get())
+    token = _current.set(log)
+    try:
+        yield log
+    finally:
+        _current.reset(token)
+
+
+class ViewStats:
+    def __init__(self, window):
+        self.requests = 0
+        self.errors = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.sql_time = 0.0
+        self.wall_time = 0.0
+        self.n_plus_one = 0
+        self.duplicate = None
+        self.wall = webhook.LatencyWindow(window)
+        self.sql = webhook.LatencyWindow(window)
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'wall_ms': {
+                'mean': round(self.wall_time / self.requests * 1000, 3),
+                **self.wall.percentiles(50, 95, 99),
+            },
+            'sql_ms': {
+                'mean': round(self.sql_time / self.requests * 1000, 3),
+                **self.sql.percentiles(50, 95, 99),
+            },
+            'queries': {
+                'mean': round(self.queries / self.requests, 2),
+                'max': self.max_queries,
+            },
+            'n_plus_one': self.n_plus_one,
+            'duplicate': self.duplicate,
+        }
+
+
+class Profiler:
+    def __init__(self, window=2048, duplicate_threshold=3, dump_path=None, dump_interval=60.0):
+        self.window = window
+        self.duplicate_threshold = duplicate_threshold
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self._lock = threading.Lock()
+        self._views = {}
+        self._since = datetime.datetime.now(datetime.UTC)
+        self._next_dump = time.monotonic() + dump_interval
+        self._dump_at_exit = False
+
+    @classmethod
+    def from_settings(cls):
+        config = {**DEFAULTS, **getattr(settings, 'PROFILING', {})}
+        return cls(
+            window=config['WINDOW'],
+            duplicate_threshold=config['DUPLICATE_THRESHOLD'],
+            dump_path=config['DUMP_PATH'],
+            dump_interval=config['DUMP_INTERVAL'],
+        )
+
+    def record(self, view, status, wall_time, log):
+        duplicates = log.duplicates(self.duplicate_threshold)
+        worst = duplicates[0] if duplicates else None
+        with self._lock:
+            stats = self._views.get(view)
+            if stats is None:
+                stats = self._views[view] = ViewStats(self.window)
+            stats.requests += 1
+            stats.errors += status >= 500
+            stats.queries += log.count
+            stats.max_queries = max(stats.max_queries, log.count)
+            stats.sql_time += log.time
+            stats.wall_time += wall_time
+            stats.wall.add(wall_time)
+            stats.sql.add(log.time)
+            if worst is not None:
+                stats.n_plus_one += 1
+                stats.duplicate = {'sql': worst[0][:500], 'times': worst[1]}
+        if worst is not None:
+            logger.warning(
+                'Possible N+1 in %s: a statement ran %d times: %.200s', view, worst[1], worst[0]
+            )
+        if self.dump_path and not self._dump_at_exit:
+            self._dump_at_exit = True
+            atexit.register(self.close)
+        if self.dump_path and time.monotonic() >= self._next_dump:
+            self._next_dump = time.monotonic() + self.dump_interval
+            self.dump()
+
+    @contextlib.contextmanager
+    def profile(self, view):
+        """Record the code run in this context as one request to ``view``."""
+        began = time.perf_counter()
+        status = 500
+        with record_queries() as log:
+            try:
+                yield log
+                status = 200
+            finally:
+                self.record(view, status, time.perf_counter() - began, log)
+
+    def stats(self):
+        with self._lock:
+            views = {name: stats.as_dict() for name, stats in sorted(self._views.items())}
+        return {'since': self._since.isoformat(), 'views': views}
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+            self._since = datetime.datetime.now(datetime.UTC)
+
+    def dump(self, path=None):
+        """Write ``stats()`` as JSON to ``path`` (``dump_path`` by default)."""
+        path = path or self.dump_path
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as fh:
+                json.dump(self.stats(), fh, indent=2)
+            os.replace(fh.name, path)
+        except OSError:
+            logger.exception('Could not write profiling stats to %s', path)
+
+    def close(self):
+        """Write the final dump."""
+        if self._dump_at_exit:
+            self._dump_at_exit = False
+            atexit.unregister(self.close)
+            self.dump()
+
+
+_profiler = None
+
+
+def is_enabled():
+    return {**DEFAULTS, **getattr(settings, 'PROFILING', {})}['ENABLED']
+
+
+def get_profiler():
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler.from_settings()
+    return _profiler
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return f'{request.method} {match.view_name if match else "<unresolved>"}'
+
+
+class ProfilingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not is_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.profiler = get_profiler()
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        began = time.perf_counter()
+        with record_queries() as log:
+            response = self.get_response(request)
+        self.profiler.record(
+            _view_name(request), response.status_code, time.perf_counter() - began, log
+        )
+        return response
+
+    async def __acall__(self, request):
+        began = time.perf_counter()
+        with record_queries() as log:
+            response = await self.get_response(request)
+        self.profiler.record(
+            _view_name(request), response.status_code, time.perf_counter() - began, log
+        )
+        return response
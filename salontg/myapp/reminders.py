@@ -0,0 +1,278 @@
+"""
+In-process scheduler for appointment reminders.
+
+Upcoming reminders sit in a heap ordered by fire time.  The scheduler loads
+every pending reminder once at start, then only looks at appointments whose
+``updated_at`` moved since its last poll and reschedules their timers;
+superseded heap entries are skipped lazily via a generation number stored
+per appointment.  Appointments are forgotten once their feedback request
+can no longer be sent, so memory follows the upcoming appointments only.
+
+Each reminder is claimed by inserting a ``ReminderLog`` row before it is
+sent.  The unique constraint on that table means a reminder goes out at most
+once per appointment time, even across restarts.  Reminders that came due
+while the scheduler was down are sent on start-up as long as they still make
+sense: a "24h" reminder is dropped once the "2h" one is due, and reminders
+that were already due when the appointment was booked are not sent at all.
+"""
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
+
+from .models import Appointment, ReminderLog
+from .telegram import TelegramError, get_api
+
+logger = logging.getLogger(__name__)
+
+REMIND_24H = ReminderLog.REMIND_24H
+REMIND_2H = ReminderLog.REMIND_2H
+FEEDBACK = ReminderLog.FEEDBACK
+
+DEFAULTS = {
+    'BEFORE_24H': datetime.timedelta(hours=24),
+    'BEFORE_2H': datetime.timedelta(hours=2),
+    'FEEDBACK_AFTER': datetime.timedelta(hours=2),
+    # How long after the visit a feedback request is still worth sending.
+    'FEEDBACK_GRACE': datetime.timedelta(days=2),
+    'POLL_INTERVAL': 5.0,
+    # Rows are re-read this far behind the newest updated_at seen, so commits
+    # that land out of order are not missed.
+    'POLL_OVERLAP': datetime.timedelta(seconds=30),
+    'RETRY_DELAY': datetime.timedelta(minutes=1),
+}
+
+MESSAGES = {
+    REMIND_24H: 'Напоминаем: {date} в {time} вас ждёт {service}, мастер {master}.',
+    REMIND_2H: 'Ждём вас сегодня в {time} на {service}, мастер {master}.',
+    FEEDBACK: 'Спасибо, что были у нас! Расскажите, как прошёл визит на {service}?',
+}
+
+
+class ReminderScheduler:
+    def __init__(self, api=None, **options):
+        config = {**DEFAULTS, **getattr(settings, 'REMINDERS', {}), **options}
+        self.before_24h = config['BEFORE_24H']
+        self.before_2h = config['BEFORE_2H']
+        self.feedback_after = config['FEEDBACK_AFTER']
+        self.feedback_grace = config['FEEDBACK_GRACE']
+        self.poll_interval = config['POLL_INTERVAL']
+        self.poll_overlap = config['POLL_OVERLAP']
+        self.retry_delay = config['RETRY_DELAY']
+        self.api = api
+        self._heap = []
+        self._seq = itertools.count()
+        # Global, so that an appointment seen again after it was forgotten
+        # cannot match heap entries left from before.
+        self._generations = itertools.count()
+        # appointment id -> (start, end, status, generation)
+        self._known = {}
+        # appointment id -> {(kind, appointment start)} already sent
+        self._sent = {}
+        # (feedback deadline, appointment id), to forget finished appointments
+        self._expiry = []
+        self._watermark = None
+        self.sent = 0
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _fire_times(self, start, end, status):
+        times = {FEEDBACK: end + self.feedback_after}
+        if status == Appointment.BOOKED:
+            times[REMIND_24H] = start - self.before_24h
+            times[REMIND_2H] = start - self.before_2h
+        return times
+
+    def _deadline(self, kind, start, end):
+        """Past this moment a reminder of ``kind`` is no longer sent."""
+        if kind == REMIND_24H:
+            return start - self.before_2h
+        if kind == REMIND_2H:
+            return start
+        return end + self.feedback_grace
+
+    def schedule(self, appointment_id, start, end, status, created_at):
+        """Create or replace the timers of one appointment."""
+        known = self._known.get(appointment_id)
+        if known is not None and known[:3] == (start, end, status):
+            return
+        generation = next(self._generations)
+        # Entries pushed for the previous values become stale; a cancelled
+        # or no-show appointment gets no new ones.
+        self._known[appointment_id] = (start, end, status, generation)
+        if known is None or known[1] != end:
+            heapq.heappush(self._expiry, (self._deadline(FEEDBACK, start, end), appointment_id))
+        if status not in Appointment.BUSY_STATUSES:
+            return
+        sent = self._sent.get(appointment_id, ())
+        for kind, fire_at in self._fire_times(start, end, status).items():
+            if fire_at < created_at:
+                continue
+            if (kind, start) not in sent:
+                heapq.heappush(
+                    self._heap, (fire_at, next(self._seq), appointment_id, kind, generation)
+                )
+
+    def load(self, now=None):
+        """Fill the heap from the database."""
+        now = now or timezone.now()
+        rows = list(
+            Appointment.objects.filter(
+                status__in=Appointment.BUSY_STATUSES,
+                end__gt=now - self.feedback_after - self.feedback_grace,
+            ).values_list('id', 'start', 'end', 'status', 'created_at', 'updated_at')
+        )
+        ids = [row[0] for row in rows]
+        self._sent = {}
+        for chunk in itertools.batched(ids, 500):
+            for appointment_id, kind, start in ReminderLog.objects.filter(
+                appointment_id__in=chunk
+            ).values_list('appointment_id', 'kind', 'appointment_start'):
+                self._sent.setdefault(appointment_id, set()).add((kind, start))
+        for appointment_id, start, end, status, created_at, _ in rows:
+            self.schedule(appointment_id, start, end, status, created_at)
+        self._watermark = max((row[5] for row in rows), default=now)
+
+    def poll_changes(self):
+        """Reschedule appointments changed since the last poll."""
+        qs = Appointment.objects.order_by('updated_at')
+        if self._watermark is not None:
+            qs = qs.filter(updated_at__gt=self._watermark - self.poll_overlap)
+        changed = 0
+        for appointment_id, start, end, status, created_at, updated_at in qs.values_list(
+            'id', 'start', 'end', 'status', 'created_at', 'updated_at'
+        ):
+            self.schedule(appointment_id, start, end, status, created_at)
+            self._watermark = max(self._watermark or updated_at, updated_at)
+            changed += 1
+        return changed
+
+    def pop_due(self, now):
+        """Pop the entries due at ``now`` that are still current."""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, _, appointment_id, kind, generation = heapq.heappop(self._heap)
+            known = self._known.get(appointment_id)
+            if known is None or known[3] != generation:
+                continue
+            start, end = known[:2]
+            if (kind, start) in self._sent.get(appointment_id, ()):
+                continue
+            if now >= self._deadline(kind, start, end):
+                self.skipped += 1
+                continue
+            due.append((appointment_id, kind, start))
+        self._forget_finished(now)
+        return due
+
+    def _forget_finished(self, now):
+        """Drop appointments past their feedback deadline; nothing is left to send."""
+        while self._expiry and self._expiry[0][0] <= now:
+            _, appointment_id = heapq.heappop(self._expiry)
+            known = self._known.get(appointment_id)
+            # A moved appointment has a later entry of its own.
+            if known is not None and self._deadline(FEEDBACK, *known[:2]) <= now:
+                del self._known[appointment_id]
+                self._sent.pop(appointment_id, None)
+
+    def next_fire_at(self):
+        return self._heap[0][0] if self._heap else None
+
+    def _claim(self, appointment_id, kind, start):
+        """Reserve a reminder; returns the message to send or ``None``."""
+        appointment = (
+            Appointment.objects.select_related('client', 'service', 'master')
+            .filter(pk=appointment_id, start=start, status__in=Appointment.BUSY_STATUSES)
+            .first()
+        )
+        # Moved or cancelled since the last poll, which will reschedule it.
+        if appointment is None:
+            return None
+        if kind != FEEDBACK and appointment.status != Appointment.BOOKED:
+            return None
+        try:
+            ReminderLog.objects.create(appointment=appointment, kind=kind, appointment_start=start)
+        except IntegrityError:
+            return None
+        text = MESSAGES[kind].format(
+            date=f'{timezone.localtime(appointment.start):%d.%m}',
+            time=f'{timezone.localtime(appointment.start):%H:%M}',
+            service=appointment.service.name,
+            master=appointment.master.name,
+        )
+        return appointment.client.chat_id, text
+
+    def _release(self, appointment_id, kind, start):
+        ReminderLog.objects.filter(
+            appointment_id=appointment_id, kind=kind, appointment_start=start
+        ).delete()
+
+    async def fire(self, appointment_id, kind, start):
+        self._sent.setdefault(appointment_id, set()).add((kind, start))
+        claimed = await sync_to_async(self._claim)(appointment_id, kind, start)
+        if claimed is None:
+            return False
+        chat_id, text = claimed
+        try:
+            await (self.api or get_api()).send_message(chat_id, text)
+        except TelegramError as exc:
+            if exc.status == 429 or exc.status >= 500:
+                await self._retry(appointment_id, kind, start, exc.retry_after)
+            else:
+                # Blocked by the user, chat gone, ...: keep the claim.
+                logger.warning('Reminder %s for #%s not delivered: %s', kind, appointment_id, exc)
+            return False
+        except Exception:
+            logger.exception('Reminder %s for #%s failed', kind, appointment_id)
+            await self._retry(appointment_id, kind, start)
+            return False
+        self.sent += 1
+        return True
+
+    async def _retry(self, appointment_id, kind, start, retry_after=None):
+        await sync_to_async(self._release)(appointment_id, kind, start)
+        self._sent.get(appointment_id, set()).discard((kind, start))
+        known = self._known.get(appointment_id)
+        if known is None:
+            return
+        delay = datetime.timedelta(seconds=retry_after) if retry_after else self.retry_delay
+        generation = known[3]
+        heapq.heappush(
+            self._heap,
+            (timezone.now() + delay, next(self._seq), appointment_id, kind, generation),
+        )
+
+    async def run_pending(self, now=None):
+        """Send everything due now; returns the number of messages sent."""
+        sent = 0
+        for appointment_id, kind, start in self.pop_due(now or timezone.now()):
+            sent += await self.fire(appointment_id, kind, start)
+        return sent
+
+    async def run(self, stop=None):
+        stop = stop or asyncio.Event()
+        await sync_to_async(self.load)()
+        logger.info('Reminder scheduler started with %d timers', len(self))
+        loop = asyncio.get_running_loop()
+        next_poll = loop.time() + self.poll_interval
+        while not stop.is_set():
+            await self.run_pending()
+            if loop.time() >= next_poll:
+                await sync_to_async(self.poll_changes)()
+                next_poll = loop.time() + self.poll_interval
+            wait = next_poll - loop.time()
+            next_fire = self.next_fire_at()
+            if next_fire is not None:
+                wait = min(wait, (next_fire - timezone.now()).total_seconds())
+            try:
+                await asyncio.wait_for(stop.wait(), max(wait, 0))
+            except TimeoutError:
+                pass
@@ -0,0 +1,74 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import availability, catalog, stats
+from .models import Appointment, Category, Master, Service
+
+
+def _master_days(master_id, start, end):
+    if master_id is None or start is None or end is None:
+        return []
+    return [(master_id, day) for day, _ in availability.interval_masks(start, end)]
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def appointment_changed(sender, instance, **kwargs):
+    touched = _master_days(instance.master_id, instance.start, instance.end)
+    original = instance.original
+    if original:
+        touched += _master_days(original['master_id'], original['start'], original['end'])
+    transaction.on_commit(lambda: availability.index.refresh(touched))
+
+
+@receiver(post_save, sender=Appointment)
+def appointment_stats_saved(sender, instance, created, **kwargs):
+    original = None if created else instance.original
+    old = original and stats.contribution(
+        original['master_id'], original['start'], original['end'], original['status'],
+        original['price'],
+    )
+    new = stats.contribution(
+        instance.master_id, instance.start, instance.end, instance.status, instance.price
+    )
+    stats.apply_change(old, new)
+
+
+@receiver(post_delete, sender=Appointment)
+def appointment_stats_deleted(sender, instance, **kwargs):
+    original = instance.original or {}
+    stats.apply_change(
+        stats.contribution(
+            original.get('master_id', instance.master_id),
+            original.get('start', instance.start),
+            original.get('end', instance.end),
+            original.get('status', instance.status),
+            original.get('price', instance.price),
+        ),
+        None,
+    )
+
+
+@receiver(post_save, sender=Master)
+@receiver(post_delete, sender=Master)
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+@receiver(m2m_changed, sender=Master.services.through)
+def schedule_changed(sender, **kwargs):
+    transaction.on_commit(availability.index.reset)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+def catalog_changed(sender, **kwargs):
+    transaction.on_commit(lambda: catalog.cache.bump(catalog.CATALOG))
+
+
+@receiver(post_save, sender=Master)
+@receiver(post_delete, sender=Master)
+@receiver(m2m_changed, sender=Master.services.through)
+def masters_changed(sender, **kwargs):
+    transaction.on_commit(lambda: catalog.cache.bump(catalog.MASTERS))
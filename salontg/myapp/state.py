@@ -0,0 +1,198 @@
+"""
+Per-chat dialog state for the booking wizard.
+
+State is kept out of the database: every wizard step would otherwise cost a
+``django_session`` read and write, and that table only ever grows.  Each chat
+gets a ``DialogState`` record with ``__slots__``; the default backend keeps
+them in an LRU-ordered dict that drops chats idle for longer than ``TTL`` and
+never holds more than ``MAX_ENTRIES`` of them.  The records are snapshotted to
+disk every ``SNAPSHOT_INTERVAL`` seconds and on exit, and loaded back on
+start, so a restart does not throw users out of the wizard.  Snapshots are
+plain JSON (one list of field values per chat), so a tampered file cannot
+run code when it is loaded.
+
+Other backends (for example one on Redis) implement ``BaseStateBackend`` and
+are selected with the ``BOT_STATE['BACKEND']`` setting.
+"""
+import atexit
+import collections
+import logging
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BACKEND': 'myapp.state.MemoryStateBackend',
+    'OPTIONS': {},
+}
+
+
+class DialogState:
+    __slots__ = (
+        'chat_id', 'step', 'client_id', 'category_id', 'service_id', 'master_id', 'touched',
+    )
+
+    def __init__(self, chat_id, step=None, client_id=None, category_id=None,
+                 service_id=None, master_id=None, touched=0.0):
+        self.chat_id = chat_id
+        self.step = step
+        self.client_id = client_id
+        self.category_id = category_id
+        self.service_id = service_id
+        self.master_id = master_id
+        self.touched = touched
+
+    def __repr__(self):
+        return f'<DialogState chat={self.chat_id} step={self.step!r}>'
+
+    def as_tuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    @classmethod
+    def from_tuple(cls, values):
+        return cls(*values)
+
+
+class BaseStateBackend:
+    def get(self, chat_id):
+        """Return the chat's ``DialogState`` or ``None``."""
+        raise NotImplementedError('subclasses of BaseStateBackend must provide a get() method')
+
+    def set(self, state):
+        raise NotImplementedError('subclasses of BaseStateBackend must provide a set() method')
+
+    def delete(self, chat_id):
+        raise NotImplementedError('subclasses of BaseStateBackend must provide a delete() method')
+
+    def get_or_create(self, chat_id):
+        state = self.get(chat_id)
+        if state is None:
+            state = DialogState(chat_id)
+        return state
+
+    def close(self):
+        pass
+
+
+class MemoryStateBackend(BaseStateBackend):
+    def __init__(self, ttl=86400, max_entries=200_000, snapshot_path=None, snapshot_interval=60):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        # Ordered by last use, so the oldest (first to expire) come first.
+        self._states = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._snapshot_at = time.monotonic() + snapshot_interval
+        self._snapshot_thread = None
+        self.evicted = 0
+        if snapshot_path:
+            self.load()
+            atexit.register(self.close)
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, chat_id):
+        now = time.time()
+        with self._lock:
+            state = self._states.get(chat_id)
+            if state is None:
+                return None
+            if state.touched + self.ttl < now:
+                del self._states[chat_id]
+                return None
+            state.touched = now
+            self._states.move_to_end(chat_id)
+            return state
+
+    def set(self, state):
+        state.touched = time.time()
+        with self._lock:
+            self._states[state.chat_id] = state
+            self._states.move_to_end(state.chat_id)
+            self._evict(state.touched)
+        self._maybe_snapshot()
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._states.pop(chat_id, None)
+
+    def _evict(self, now):
+        states = self._states
+        while states:
+            chat_id, oldest = next(iter(states.items()))
+            if len(states) <= self.max_entries and oldest.touched + self.ttl >= now:
+                break
+            del states[chat_id]
+            self.evicted += 1
+
+    def _maybe_snapshot(self):
+        if not self.snapshot_path or time.monotonic() < self._snapshot_at:
+            return
+        self._snapshot_at = time.monotonic() + self.snapshot_interval
+        if self._snapshot_thread is not None and self._snapshot_thread.is_alive():
+            return
+        records = self._records()
+        self._snapshot_thread = threading.Thread(
+            target=self._write, args=(records,), name='state-snapshot', daemon=True
+        )
+        self._snapshot_thread.start()
+
+    def _records(self):
+        with self._lock:
+            return [state.as_tuple() for state in self._states.values()]
+
+    def _write(self, records):
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as fh:
+                json.dump(records, fh, separators=(',', ':'))
+            os.replace(fh.name, self.snapshot_path)
+        except OSError:
+            logger.exception('Could not write dialog state snapshot to %s', self.snapshot_path)
+
+    def snapshot(self):
+        """Write all live states to ``snapshot_path`` now."""
+        self._write(self._records())
+
+    def load(self):
+        try:
+            with open(self.snapshot_path) as fh:
+                states = [DialogState.from_tuple(values) for values in json.load(fh)]
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError):
+            logger.exception('Ignoring unreadable dialog state snapshot %s', self.snapshot_path)
+            return
+        now = time.time()
+        with self._lock:
+            for state in states:
+                if state.touched + self.ttl >= now:
+                    self._states[state.chat_id] = state
+            self._evict(now)
+
+    def close(self):
+        if self.snapshot_path:
+            atexit.unregister(self.close)
+            if self._snapshot_thread is not None:
+                self._snapshot_thread.join()
+            self.snapshot()
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        config = {**DEFAULTS, **getattr(settings, 'BOT_STATE', {})}
+        _store = import_string(config['BACKEND'])(**config['OPTIONS'])
+    return _store
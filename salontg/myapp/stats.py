@@ -0,0 +1,145 @@
+"""
+Occupancy and revenue aggregates.
+
+``DailyStats`` holds one row per master and day.  Every appointment save or
+delete (see ``myapp.signals``) subtracts the appointment's previous
+contribution and adds the new one within the same transaction, so report
+pages only read the small aggregate table.  ``rebuild()`` recomputes it from
+scratch after bulk edits that bypass signals (``manage.py rebuild_stats``).
+"""
+import collections
+import datetime
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .availability import day_start
+from .models import Appointment, DailyStats
+
+COUNTERS = {
+    Appointment.BOOKED: 'booked',
+    Appointment.COMPLETED: 'completed',
+    Appointment.CANCELLED: 'cancelled',
+    Appointment.NO_SHOW: 'no_show',
+}
+FIELDS = ['booked', 'completed', 'cancelled', 'no_show', 'busy_minutes', 'revenue']
+
+
+def contribution(master_id, start, end, status, price):
+    """The ``((date, master_id), values)`` an appointment adds to the totals."""
+    if master_id is None or start is None or status not in COUNTERS:
+        return None
+    values = {COUNTERS[status]: 1}
+    if status in Appointment.BUSY_STATUSES and end is not None:
+        values['busy_minutes'] = int((end - start).total_seconds() // 60)
+    if status == Appointment.COMPLETED and price:
+        values['revenue'] = Decimal(price)
+    return (timezone.localdate(start), master_id), values
+
+
+def apply_change(old, new):
+    """Move one appointment's contribution from ``old`` to ``new``."""
+    deltas = collections.defaultdict(lambda: collections.defaultdict(int))
+    for sign, item in ((-1, old), (1, new)):
+        if item is not None:
+            key, values = item
+            for name, value in values.items():
+                deltas[key][name] += sign * value
+    for (day, master_id), values in deltas.items():
+        values = {name: value for name, value in values.items() if value}
+        if not values:
+            continue
+        qs = DailyStats.objects.filter(date=day, master_id=master_id)
+        if qs.update(**{name: F(name) + value for name, value in values.items()}):
+            continue
+        try:
+            with transaction.atomic():
+                DailyStats.objects.create(date=day, master_id=master_id, **values)
+        except IntegrityError:
+            qs.update(**{name: F(name) + value for name, value in values.items()})
+
+
+def rebuild(chunk_size=5000):
+    """Recompute every ``DailyStats`` row from the appointments."""
+    totals = collections.defaultdict(lambda: collections.defaultdict(int))
+    rows = Appointment.objects.values_list('master_id', 'start', 'end', 'status', 'price')
+    for row in rows.iterator(chunk_size=chunk_size):
+        item = contribution(*row)
+        if item is not None:
+            key, values = item
+            for name, value in values.items():
+                totals[key][name] += value
+    with transaction.atomic():
+        DailyStats.objects.all().delete()
+        DailyStats.objects.bulk_create(
+            (
+                DailyStats(date=day, master_id=master_id, **values)
+                for (day, master_id), values in totals.items()
+            ),
+            batch_size=1000,
+        )
+    return len(totals)
+
+
+def _rates(row, days=None, work_minutes=None):
+    visits = row['completed'] + row['no_show']
+    row['no_show_rate'] = row['no_show'] / visits if visits else None
+    if days and work_minutes:
+        row['occupancy'] = row['busy_minutes'] / (days * work_minutes)
+    return row
+
+
+def _totals(qs):
+    return qs.annotate(**{name: Sum(name) for name in FIELDS})
+
+
+def daily_report(first, last):
+    qs = DailyStats.objects.filter(date__range=(first, last)).values('date').order_by('date')
+    return [_rates(row) for row in _totals(qs)]
+
+
+def weekly_report(daily):
+    weeks = {}
+    for row in daily:
+        week = row['date'] - datetime.timedelta(days=row['date'].weekday())
+        total = weeks.setdefault(week, {'week': week, **{name: 0 for name in FIELDS}})
+        for name in FIELDS:
+            total[name] += row[name]
+    return [_rates(row) for row in weeks.values()]
+
+
+def master_report(first, last):
+    days = (last - first).days + 1
+    qs = (
+        DailyStats.objects.filter(date__range=(first, last))
+        .values('master', 'master__name', 'master__work_start', 'master__work_end')
+        .order_by('master__name')
+    )
+    rows = []
+    for row in _totals(qs):
+        start, end = row['master__work_start'], row['master__work_end']
+        work_minutes = (end.hour * 60 + end.minute) - (start.hour * 60 + start.minute)
+        rows.append(_rates(row, days, work_minutes))
+    return rows
+
+
+def appointment_rows(first, last, chunk_size=2000):
+    """Appointments between two dates as export rows, read lazily."""
+    qs = (
+        Appointment.objects.filter(
+            start__gte=day_start(first),
+            start__lt=day_start(last + datetime.timedelta(days=1)),
+        )
+        .order_by('start', 'pk')
+        .values_list(
+            'start', 'master__name', 'service__name', 'client__name', 'client__phone', 'status',
+            'price',
+        )
+    )
+    for start, *rest in qs.iterator(chunk_size=chunk_size):
+        yield (timezone.localtime(start).strftime('%Y-%m-%d %H:%M'), *rest)
+
+
+EXPORT_HEADER = ['Start', 'Master', 'Service', 'Client', 'Phone', 'Status', 'Price']
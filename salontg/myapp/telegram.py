@@ -0,0 +1,87 @@
+"""
+Minimal asynchronous Telegram Bot API client.
+
+One pooled ``httpx.AsyncClient`` is kept per event loop so requests reuse
+keep-alive connections to the Bot API.
+"""
+import asyncio
+
+import httpx
+from django.conf import settings
+
+
+class TelegramError(Exception):
+    def __init__(self, status, description, retry_after=None):
+        super().__init__(f'{status}: {description}')
+        self.status = status
+        self.description = description
+        self.retry_after = retry_after
+
+
+class BotAPI:
+    def __init__(self, token=None, base_url=None, timeout=10.0, max_connections=100):
+        self.token = token if token is not None else settings.TELEGRAM_BOT_TOKEN
+        self.base_url = base_url or getattr(settings, 'TELEGRAM_API_URL', 'https://api.telegram.org')
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._clients = {}
+
+    @property
+    def client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = httpx.AsyncClient(
+                base_url=f'{self.base_url}/bot{self.token}/',
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return client
+
+    async def call(self, method, **params):
+        params = {key: value for key, value in params.items() if value is not None}
+        response = await self.client.post(method, json=params)
+        try:
+            payload = response.json()
+        except ValueError:
+            raise TelegramError(response.status_code, response.text)
+        if not payload.get('ok'):
+            raise TelegramError(
+                payload.get('error_code', response.status_code),
+                payload.get('description', ''),
+                payload.get('parameters', {}).get('retry_after'),
+            )
+        return payload['result']
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        return await self.call('sendMessage', chat_id=chat_id, text=text, reply_markup=reply_markup)
+
+    async def edit_message(self, chat_id, message_id, text, reply_markup=None):
+        return await self.call(
+            'editMessageText',
+            chat_id=chat_id,
+            message_id=message_id,
+            text=text,
+            reply_markup=reply_markup,
+        )
+
+    async def answer_callback(self, callback_query_id, text=None):
+        return await self.call('answerCallbackQuery', callback_query_id=callback_query_id, text=text)
+
+    async def aclose(self):
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+_api = None
+
+
+def get_api():
+    global _api
+    if _api is None:
+        _api = BotAPI()
+    return _api
@@ -1,3 +1,1294 @@
-from django.test import TestCase
+import asyncio
+import collections
+import datetime
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import Permission, User
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    availability, bot, booking, broadcast, catalog, export, profiling, reminders, state, stats,
+    webhook,
+)
+from .broadcast import BroadcastRunner, claim
+from .fakebot import FakeBotServer
+from .telegram import BotAPI
+from .models import (
+    Appointment, Broadcast, Category, Client, DailyStats, Master, ReminderLog, Service,
+)
+
+
+def make_salon(masters=2):
+    category = Category.objects.create(name='Hair')
+    service = Service.objects.create(
+        category=category, name='Haircut', price=Decimal('1500'), duration_minutes=45
+    )
+    staff = []
+    for i in range(masters):
+        master = Master.objects.create(
+            name=f'Master {i}', work_start=datetime.time(10), work_end=datetime.time(18)
+        )
+        master.services.add(service)
+        staff.append(master)
+    client = Client.objects.create(telegram_id=1, chat_id=1, name='Anna')
+    return service, staff, client
+
+
+def at(day, hour, minute=0):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time(hour, minute)))
+
+
+class FitMaskTests(TestCase):
+    def test_runs_shorter_than_service_are_skipped(self):
+        free = 0b1110111101
+        self.assertEqual(availability.fit_mask(free, 1), free)
+        self.assertEqual(availability.fit_mask(free, 3), 0b0010001100)
+        self.assertEqual(availability.fit_mask(free, 4), 0b0000000100)
+        self.assertEqual(availability.fit_mask(free, 5), 0)
+
+
+class AvailabilityIndexTests(TestCase):
+    def setUp(self):
+        availability.index.reset()
+        self.service, self.masters, self.client = make_salon()
+        self.tomorrow = timezone.localdate() + datetime.timedelta(days=1)
+        self.now = at(self.tomorrow, 0)
+
+    def book(self, master, start):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Appointment.objects.create(
+                client=self.client, master=master, service=self.service, start=start
+            )
+
+    def test_earliest_slots_across_masters(self):
+        slots = availability.find_free_slots(self.service, count=3, now=self.now)
+        self.assertEqual(
+            [(slot.start, slot.master_id) for slot in slots],
+            [
+                (at(self.tomorrow, 10), self.masters[0].pk),
+                (at(self.tomorrow, 10, 5), self.masters[0].pk),
+                (at(self.tomorrow, 10, 10), self.masters[0].pk),
+            ],
+        )
+
+    def test_booking_updates_only_that_master_day(self):
+        availability.find_free_slots(self.service, now=self.now)
+        self.book(self.masters[0], at(self.tomorrow, 10))
+        slots = availability.find_free_slots(self.service, count=1, now=self.now)
+        self.assertEqual(slots[0], (at(self.tomorrow, 10), self.masters[1].pk))
+        slots = availability.find_free_slots(
+            self.service, count=1, now=self.now, master=self.masters[0]
+        )
+        self.assertEqual(slots[0].start, at(self.tomorrow, 10, 45))
+
+    def test_cancellation_frees_the_slot(self):
+        appointment = self.book(self.masters[0], at(self.tomorrow, 10))
+        self.assertFalse(
+            availability.index.is_free(self.masters[0].pk, self.service.pk, at(self.tomorrow, 10))
+        )
+        appointment.status = Appointment.CANCELLED
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.save()
+        self.assertTrue(
+            availability.index.is_free(self.masters[0].pk, self.service.pk, at(self.tomorrow, 10))
+        )
+
+    def test_moving_a_booking_frees_the_old_day(self):
+        appointment = self.book(self.masters[0], at(self.tomorrow, 10))
+        availability.find_free_slots(self.service, now=self.now)
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        appointment.start = at(self.tomorrow + datetime.timedelta(days=1), 10)
+        appointment.end = appointment.start + datetime.timedelta(minutes=45)
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.save()
+        self.assertTrue(
+            availability.index.is_free(self.masters[0].pk, self.service.pk, at(self.tomorrow, 10))
+        )
+
+    def test_end_of_day_is_respected(self):
+        slots = availability.find_free_slots(
+            self.service, count=200, now=self.now, master=self.masters[0], days=1
+        )
+        self.assertEqual(slots[-1].start, at(self.tomorrow, 17, 15))
+
+    def test_search_does_not_query_once_warm(self):
+        availability.find_free_slots(self.service, now=self.now)
+        with self.assertNumQueries(0):
+            availability.find_free_slots(self.service, count=10, now=self.now)
+
+    def test_changes_from_other_processes_are_picked_up(self):
+        index = availability.AvailabilityIndex(max_age=60)
+        master, start = self.masters[0].pk, at(self.tomorrow, 10)
+        self.assertTrue(index.is_free(master, self.service.pk, start))
+        # bulk_create sends no signals, like a write made in another process.
+        Appointment.objects.bulk_create([Appointment(
+            client=self.client, master=self.masters[0], service=self.service, start=start,
+            end=start + datetime.timedelta(minutes=45), price=self.service.price,
+        )])
+        self.assertTrue(index.is_free(master, self.service.pk, start))
+        later = time.monotonic() + 61
+        with mock.patch('myapp.availability.time.monotonic', return_value=later):
+            with self.assertNumQueries(1):
+                self.assertFalse(index.is_free(master, self.service.pk, start))
+            with self.assertNumQueries(0):
+                index.find_free_slots(self.service.pk, now=self.now, days=1)
+
+
+def message_update(update_id, chat_id, text='hi'):
+    return {'update_id': update_id, 'message': {'chat': {'id': chat_id}, 'text': text}}
+
+
+class UpdateDispatcherTests(SimpleTestCase):
+    def test_duplicates_are_dropped(self):
+        handled = []
+
+        async def handler(update):
+            handled.append(update['update_id'])
+
+        async def scenario():
+            dispatcher = webhook.UpdateDispatcher(handler, workers=2)
+            results = [await dispatcher.submit(message_update(i % 3, 1)) for i in range(6)]
+            await dispatcher.join()
+            await dispatcher.stop()
+            return results, dispatcher.stats()
+
+        results, stats = asyncio.run(scenario())
+        self.assertEqual(results.count(webhook.QUEUED), 3)
+        self.assertEqual(results.count(webhook.DUPLICATE), 3)
+        self.assertEqual(sorted(handled), [0, 1, 2])
+        self.assertEqual(stats['processed'], 3)
+
+    def test_chat_order_is_kept_while_chats_run_in_parallel(self):
+        handled = {}
+
+        async def handler(update):
+            chat_id = update['message']['chat']['id']
+            await asyncio.sleep(0.001 * (update['update_id'] % 3))
+            handled.setdefault(chat_id, []).append(update['update_id'])
+
+        async def scenario():
+            dispatcher = webhook.UpdateDispatcher(handler, workers=4)
+            for i in range(60):
+                await dispatcher.submit(message_update(i, i % 5))
+            await dispatcher.join()
+            await dispatcher.stop()
+
+        asyncio.run(scenario())
+        for chat_id, ids in handled.items():
+            self.assertEqual(ids, sorted(ids))
+        self.assertEqual(sum(len(ids) for ids in handled.values()), 60)
+
+    def test_full_queue_rejects_and_allows_retry(self):
+        async def scenario():
+            gate = asyncio.Event()
+
+            async def handler(update):
+                await gate.wait()
+
+            dispatcher = webhook.UpdateDispatcher(handler, workers=1, queue_size=1)
+            first = await dispatcher.submit(message_update(1, 1))
+            await asyncio.sleep(0)  # the worker takes update 1
+            second = await dispatcher.submit(message_update(2, 1))
+            third = await dispatcher.submit(message_update(3, 1))
+            gate.set()
+            await dispatcher.join()
+            retried = await dispatcher.submit(message_update(3, 1))
+            await dispatcher.join()
+            await dispatcher.stop()
+            return first, second, third, retried
+
+        self.assertEqual(
+            asyncio.run(scenario()),
+            (webhook.QUEUED, webhook.QUEUED, webhook.REJECTED, webhook.QUEUED),
+        )
+
+
+@override_settings(TELEGRAM_WEBHOOK_SECRET='s3cret')
+class TelegramWebhookViewTests(SimpleTestCase):
+    async def test_secret_token_is_checked(self):
+        response = await self.async_client.post(
+            reverse('myapp:telegram-webhook'), message_update(1, 1), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 403)
+
+    async def test_update_is_accepted(self):
+        response = await self.async_client.post(
+            reverse('myapp:telegram-webhook'),
+            message_update(10, 1),
+            content_type='application/json',
+            headers={'X-Telegram-Bot-Api-Secret-Token': 's3cret'},
+        )
+        self.assertEqual(response.status_code, 200)
+        await webhook.get_dispatcher().join()
+
+
+class BookingWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.service, self.masters, self.client = make_salon(masters=3)
+        self.writer = booking.BookingWriter()
+        self.start = at(timezone.localdate() + datetime.timedelta(days=1), 10)
+
+    def tearDown(self):
+        self.writer.stop()
+
+    def test_second_booking_of_a_slot_is_rejected(self):
+        first = self.writer.book(self.client.pk, self.masters[0].pk, self.service.pk, self.start)
+        overlapping = self.start + datetime.timedelta(minutes=30)
+        second = self.writer.book(self.client.pk, self.masters[0].pk, self.service.pk, overlapping)
+        self.assertEqual(first.status, booking.BOOKED)
+        self.assertEqual(second, (booking.SLOT_TAKEN, None))
+
+    def test_cancel_and_move(self):
+        result = self.writer.book(self.client.pk, self.masters[0].pk, self.service.pk, self.start)
+        later = self.start + datetime.timedelta(hours=2)
+        moved = self.writer.move(result.appointment.pk, later)
+        self.assertEqual(moved.status, booking.MOVED)
+        self.assertEqual(Appointment.objects.get().start, later)
+        self.assertEqual(self.writer.cancel(result.appointment.pk).status, booking.CANCELLED)
+        again = self.writer.book(self.client.pk, self.masters[0].pk, self.service.pk, later)
+        self.assertEqual(again.status, booking.BOOKED)
+
+    def test_status_changes_cannot_double_book(self):
+        master = self.masters[0].pk
+        first = self.writer.book(self.client.pk, master, self.service.pk, self.start).appointment
+        self.assertEqual(self.writer.cancel(first.pk).status, booking.CANCELLED)
+        self.assertEqual(self.writer.cancel(first.pk).status, booking.NOT_FOUND)
+        second = self.writer.book(self.client.pk, master, self.service.pk, self.start)
+        self.assertEqual(second.status, booking.BOOKED)
+        reactivated = self.writer.set_status(first.pk, Appointment.BOOKED)
+        self.assertEqual(reactivated.status, booking.SLOT_TAKEN)
+        self.assertEqual(self.writer.set_status(first.pk, 'garbage').status, booking.INVALID)
+        self.assertEqual(Appointment.objects.get(pk=first.pk).status, Appointment.CANCELLED)
+        self.writer.cancel(second.appointment.pk)
+        reactivated = self.writer.set_status(first.pk, Appointment.BOOKED)
+        self.assertEqual(reactivated.status, Appointment.BOOKED)
+
+    def test_unbookable_times_are_rejected(self):
+        other = Service.objects.create(
+            category=self.service.category, name='Color', price=Decimal('3000'), duration_minutes=60
+        )
+        inactive = Master.objects.create(
+            name='Away', work_start=datetime.time(10), work_end=datetime.time(18), is_active=False
+        )
+        inactive.services.add(self.service)
+        master = self.masters[0].pk
+        for master_id, service_id, start in (
+            (master, self.service.pk, at(timezone.localdate() - datetime.timedelta(days=1), 12)),
+            (master, self.service.pk, self.start.replace(hour=9)),
+            (master, self.service.pk, self.start.replace(hour=17, minute=30)),
+            (master, other.pk, self.start),
+            (inactive.pk, self.service.pk, self.start),
+            (master, 0, self.start),
+        ):
+            result = self.writer.book(self.client.pk, master_id, service_id, start)
+            self.assertEqual(result, (booking.INVALID, None), (master_id, service_id, start))
+        appointment = self.writer.book(self.client.pk, master, self.service.pk, self.start).appointment
+        moved = self.writer.move(appointment.pk, self.start.replace(hour=20))
+        self.assertEqual(moved.status, booking.INVALID)
+        self.assertFalse(Appointment.objects.exclude(pk=appointment.pk).exists())
+
+    def test_cancelled_future_does_not_stop_the_writer(self):
+        writer = booking.BookingWriter(batch_delay=0.05)
+        self.addCleanup(writer.stop)
+        cancelled, waiting = Future(), Future()
+        later = self.start + datetime.timedelta(hours=2)
+        # Both land in one batch; the first caller gave up while queued.
+        for future, start in ((cancelled, self.start), (waiting, later)):
+            writer._queue.put(
+                (booking._book, (self.client.pk, self.masters[0].pk, self.service.pk, start), future)
+            )
+        cancelled.cancel()
+        writer.start()
+        self.assertEqual(waiting.result(timeout=5).status, booking.BOOKED)
+        self.assertTrue(writer._thread.is_alive())
+        self.assertEqual(list(Appointment.objects.values_list('start', flat=True)), [later])
+
+    def test_concurrent_attempts_never_double_book(self):
+        attempts = 3000
+        # 3 masters x 24 start times spread over the day, many overlapping.
+        starts = [self.start + datetime.timedelta(minutes=15 * i) for i in range(24)]
+        rng = random.Random(42)
+        requests = [
+            (self.client.pk, rng.choice(self.masters).pk, self.service.pk, rng.choice(starts))
+            for _ in range(attempts)
+        ]
+        began = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=64) as pool:
+            results = list(pool.map(lambda args: self.writer.book(*args, timeout=60), requests))
+        elapsed = time.perf_counter() - began
+
+        booked = [result for result in results if result.status == booking.BOOKED]
+        self.assertEqual(len(booked) + results.count((booking.SLOT_TAKEN, None)), attempts)
+        self.assertEqual(Appointment.objects.count(), len(booked))
+        for master in self.masters:
+            rows = list(master.appointments.order_by('start').values_list('start', 'end'))
+            for (_, previous_end), (start, _) in zip(rows, rows[1:]):
+                self.assertGreaterEqual(start, previous_end)
+        self.assertLess(self.writer.commits, attempts)
+        throughput = attempts / elapsed
+        self.assertGreater(throughput, 100, f'{throughput:.0f} booking attempts/s')
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        catalog.cache.clear()
+        self.service, self.masters, self.client = make_salon()
+
+    def test_hit_does_no_queries(self):
+        hits = catalog.cache.hits
+        screen = catalog.services_screen(self.service.category_id)
+        self.assertIn('Haircut — 1500 ₽', screen.reply_markup)
+        with self.assertNumQueries(0):
+            self.assertIs(catalog.services_screen(self.service.category_id), screen)
+        self.assertEqual(catalog.cache.hits - hits, 1)
+
+    def test_admin_edit_invalidates(self):
+        misses = catalog.cache.misses
+        catalog.price_list_screen()
+        catalog.masters_screen(self.service.pk)
+        self.service.price = Decimal('1700')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.service.save()
+        self.assertIn('1700 ₽', catalog.price_list_screen().text)
+
+        self.masters[0].name = 'Olga'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.masters[0].save()
+        self.assertIn('Olga', catalog.masters_screen(self.service.pk).reply_markup)
+        self.assertEqual(catalog.cache.misses - misses, 4)
+
+    def test_evicted_version_does_not_revive_stale_entries(self):
+        cache = catalog.VersionedCache(version_check_interval=-1)
+        caches['default'].delete_many(['myapp:version:catalog', 'myapp:version:masters'])
+        cache.get_or_build('prices', (catalog.CATALOG,), lambda: 'old')
+        cache.bump(catalog.CATALOG)
+        self.assertEqual(cache.get_or_build('prices', (catalog.CATALOG,), lambda: 'new'), 'new')
+        # Culled by unrelated cache use, e.g. the admin's cached counts.
+        caches['default'].delete('myapp:version:catalog')
+        built = cache.get_or_build('prices', (catalog.CATALOG,), lambda: 'rebuilt')
+        self.assertEqual(built, 'rebuilt')
+        self.assertGreater(caches['default'].get('myapp:version:catalog'), 1)
+        other = catalog.VersionedCache(version_check_interval=-1)
+        other._versions[catalog.CATALOG] = 10
+        caches['default'].delete('myapp:version:catalog')
+        other.bump(catalog.CATALOG)
+        self.assertEqual(caches['default'].get('myapp:version:catalog'), 11)
+
+    def test_lru_and_ttl(self):
+        cache = catalog.VersionedCache(max_entries=2, ttl=60)
+        for key in 'abc':
+            cache.get_or_build(key, (catalog.CATALOG,), lambda: key)
+        self.assertEqual(cache.stats()['entries'], 2)
+        cache.get_or_build('a', (catalog.CATALOG,), lambda: 'a')
+        self.assertEqual(cache.misses, 4)
+        expired = catalog.VersionedCache(ttl=-1)
+        expired.get_or_build('a', (catalog.CATALOG,), lambda: 'a')
+        expired.get_or_build('a', (catalog.CATALOG,), lambda: 'a')
+        self.assertEqual(expired.hits, 0)
+
+
+class MemoryStateBackendTests(SimpleTestCase):
+    def test_idle_chats_expire(self):
+        store = state.MemoryStateBackend(ttl=60)
+        store.set(state.DialogState(1, step='service', service_id=5))
+        self.assertEqual(store.get(1).service_id, 5)
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertIsNone(store.get(1))
+
+    def test_memory_cap_drops_least_recently_used(self):
+        store = state.MemoryStateBackend(max_entries=3)
+        for chat_id in range(3):
+            store.set(state.DialogState(chat_id))
+        store.get(0)
+        store.set(state.DialogState(3))
+        self.assertEqual(len(store), 3)
+        self.assertIsNone(store.get(1))
+        self.assertIsNotNone(store.get(0))
+        self.assertEqual(store.evicted, 1)
+
+    def test_snapshot_survives_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'state.json')
+            store = state.MemoryStateBackend(snapshot_path=path)
+            store.set(state.DialogState(7, step='master', service_id=2, master_id=3))
+            store.close()
+            restored = state.MemoryStateBackend(snapshot_path=path)
+            restored.close()
+            self.assertEqual(restored.get(7).as_tuple()[:-1], (7, 'master', None, None, 2, 3))
+
+    def test_snapshot_is_json_and_bad_files_are_ignored(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'state.json')
+            store = state.MemoryStateBackend(snapshot_path=path)
+            store.set(state.DialogState(7, step='master'))
+            store.close()
+            with open(path) as fh:
+                self.assertEqual(json.load(fh)[0][:3], [7, 'master', None])
+            for content in ('{not json', '[[1, 2, 3, 4, 5, 6, 7, 8, 9]]'):
+                with open(path, 'w') as fh:
+                    fh.write(content)
+                with self.assertLogs('myapp.state', 'ERROR'):
+                    restored = state.MemoryStateBackend(snapshot_path=path)
+                restored.close()
+                self.assertEqual(len(restored), 0)
+
+
+class FakeBotAPI:
+    def __init__(self):
+        self.calls = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.calls.append(('send', chat_id, text, reply_markup))
+
+    async def edit_message(self, chat_id, message_id, text, reply_markup=None):
+        self.calls.append(('edit', chat_id, text, reply_markup))
+
+    async def answer_callback(self, callback_query_id, text=None):
+        self.calls.append(('answer', callback_query_id, text))
+
+
+class BookingWizardTests(TestCase):
+    def setUp(self):
+        availability.index.reset()
+        catalog.cache.clear()
+        self.service, self.masters, self.client = make_salon()
+        self.store = state.MemoryStateBackend()
+        self.api = FakeBotAPI()
+        for name, value in (('get_store', self.store), ('get_api', self.api)):
+            patcher = mock.patch.object(bot, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def press(self, data):
+        callback = {
+            'id': 'q',
+            'data': data,
+            'from': {'id': 1},
+            'message': {'message_id': 10, 'chat': {'id': 1}},
+        }
+        async_to_sync(bot.handle_update)({'update_id': 1, 'callback_query': callback})
+
+    def test_wizard_steps_stay_off_the_database(self):
+        for data in ('catalog', f'cat:{self.service.category_id}', f'svc:{self.service.pk}',
+                     f'mst:{self.service.pk}:0'):
+            self.press(data)
+        self.assertEqual(self.store.get(1).service_id, self.service.pk)
+        with self.assertNumQueries(0):
+            self.press(f'cat:{self.service.category_id}')
+            self.press(f'svc:{self.service.pk}')
+            self.press(f'mst:{self.service.pk}:{self.masters[1].pk}')
+        keyboard = json.loads(self.api.calls[-1][3])
+        self.assertTrue(keyboard['inline_keyboard'][0][0]['callback_data'].startswith('slot:'))
+        self.assertEqual(self.store.get(1).master_id, self.masters[1].pk)
+
+    def test_taken_slot_is_refreshed_before_showing_slots_again(self):
+        availability.index.reset()
+        master = self.masters[0]
+        self.press(f'svc:{self.service.pk}')
+        self.press(f'mst:{self.service.pk}:{master.pk}')
+        keyboard = json.loads(self.api.calls[-1][3])
+        data = keyboard['inline_keyboard'][0][0]['callback_data']
+        start = datetime.datetime.fromtimestamp(int(data.split(':')[1]), tz=datetime.UTC)
+        # Booked by another process, so this one's index never heard of it.
+        Appointment.objects.bulk_create([Appointment(
+            client=self.client, master=master, service=self.service, start=start,
+            end=start + datetime.timedelta(minutes=45), price=self.service.price,
+        )])
+        taken = booking.BookingResult(booking.SLOT_TAKEN)
+        writer = mock.Mock(abook=mock.AsyncMock(return_value=taken))
+        with mock.patch.object(booking, 'get_writer', return_value=writer):
+            self.press(data)
+        keyboard = json.loads(self.api.calls[-1][3])
+        offered = [row[0]['callback_data'] for row in keyboard['inline_keyboard'][:-1]]
+        self.assertNotIn(data, offered)
+
+
+class ReminderSchedulerTests(TestCase):
+    def setUp(self):
+        self.service, self.masters, self.client = make_salon()
+        self.start = at(timezone.localdate() + datetime.timedelta(days=3), 12)
+        self.appointment = Appointment.objects.create(
+            client=self.client, master=self.masters[0], service=self.service, start=self.start
+        )
+        self.api = FakeBotAPI()
+
+    def scheduler(self):
+        scheduler = reminders.ReminderScheduler(api=self.api)
+        scheduler.load()
+        return scheduler
+
+    def run_at(self, scheduler, moment):
+        return async_to_sync(scheduler.run_pending)(now=moment)
+
+    def test_reminders_fire_once_across_restarts(self):
+        scheduler = self.scheduler()
+        self.assertEqual(self.run_at(scheduler, self.start - datetime.timedelta(hours=25)), 0)
+        self.assertEqual(self.run_at(scheduler, self.start - datetime.timedelta(hours=23)), 1)
+        self.assertIn('вас ждёт Haircut', self.api.calls[0][2])
+        restarted = self.scheduler()
+        self.assertEqual(self.run_at(restarted, self.start - datetime.timedelta(hours=23)), 0)
+        self.assertEqual(self.run_at(restarted, self.start - datetime.timedelta(hours=1)), 1)
+        self.assertEqual(self.run_at(restarted, self.start + datetime.timedelta(hours=3)), 1)
+        self.assertEqual(
+            sorted(ReminderLog.objects.values_list('kind', flat=True)),
+            [reminders.REMIND_24H, reminders.REMIND_2H, reminders.FEEDBACK],
+        )
+
+    def test_missed_24h_reminder_gives_way_to_2h(self):
+        scheduler = self.scheduler()
+        self.assertEqual(self.run_at(scheduler, self.start - datetime.timedelta(hours=1)), 1)
+        self.assertEqual(ReminderLog.objects.get().kind, reminders.REMIND_2H)
+        self.assertEqual(scheduler.skipped, 1)
+
+    def test_moves_and_cancellations_are_picked_up_incrementally(self):
+        scheduler = self.scheduler()
+        self.run_at(scheduler, self.start - datetime.timedelta(hours=23))
+        moved = self.start + datetime.timedelta(days=1)
+        self.appointment.start = moved
+        self.appointment.end = moved + datetime.timedelta(minutes=45)
+        self.appointment.save()
+        other = Appointment.objects.create(
+            client=self.client, master=self.masters[1], service=self.service, start=self.start
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(scheduler.poll_changes(), 2)
+        other.status = Appointment.CANCELLED
+        other.save(update_fields=['status'])
+        scheduler.poll_changes()
+        self.assertEqual(self.run_at(scheduler, self.start - datetime.timedelta(hours=1)), 0)
+        self.assertEqual(self.run_at(scheduler, moved - datetime.timedelta(hours=23)), 1)
+        self.assertEqual(ReminderLog.objects.filter(appointment=other).count(), 0)
+
+    def test_finished_appointments_are_forgotten(self):
+        scheduler = self.scheduler()
+        self.run_at(scheduler, self.start - datetime.timedelta(hours=23))
+        self.assertIn(self.appointment.pk, scheduler._sent)
+        end = self.appointment.end
+        self.run_at(scheduler, end + scheduler.feedback_grace - datetime.timedelta(minutes=1))
+        self.assertIn(self.appointment.pk, scheduler._known)
+        self.run_at(scheduler, end + scheduler.feedback_grace)
+        self.assertEqual((scheduler._known, scheduler._sent, len(scheduler)), ({}, {}, 0))
+
+    def test_late_booking_gets_no_24h_reminder(self):
+        soon = timezone.now() + datetime.timedelta(hours=5)
+        self.appointment.delete()
+        Appointment.objects.create(
+            client=self.client, master=self.masters[0], service=self.service, start=soon
+        )
+        scheduler = self.scheduler()
+        self.assertEqual(self.run_at(scheduler, timezone.now()), 0)
+        self.assertEqual(self.run_at(scheduler, soon - datetime.timedelta(hours=1)), 1)
+        self.assertEqual(ReminderLog.objects.get().kind, reminders.REMIND_2H)
+
+
+class BroadcastTests(TestCase):
+    def setUp(self):
+        Client.objects.bulk_create(
+            Client(telegram_id=chat_id, chat_id=chat_id) for chat_id in range(1, 301)
+        )
+        self.broadcast = Broadcast.objects.create(text='Скидка 20% на стрижки')
+
+    def send(self, server_options, **options):
+        async def scenario():
+            async with FakeBotServer(**server_options) as server:
+                api = BotAPI(token='test', base_url=server.url)
+                runner = BroadcastRunner(self.broadcast.pk, api=api, **options)
+                try:
+                    await runner.run()
+                finally:
+                    await api.aclose()
+                return server, runner
+
+        server, runner = async_to_sync(scenario)()
+        self.broadcast.refresh_from_db()
+        return server, runner
+
+    def test_rate_limit_is_respected(self):
+        began = time.monotonic()
+        server, runner = self.send(
+            {'rate_limit': 200, 'blocked': {7}, 'latency': 0.01},
+            GLOBAL_RATE=180, CONCURRENCY=16, CHECKPOINT_EVERY=50,
+        )
+        elapsed = time.monotonic() - began
+        self.assertEqual(server.throttled, 0)
+        self.assertLessEqual(server.peak_rate(), 200)
+        self.assertEqual(len({chat_id for _, chat_id, _ in server.messages}), 299)
+        self.assertEqual(self.broadcast.status, Broadcast.DONE)
+        self.assertEqual((self.broadcast.sent, self.broadcast.blocked), (299, 1))
+        self.assertEqual(self.broadcast.last_client_id, Client.objects.latest('pk').pk)
+        self.assertGreater(299 / elapsed, 100)
+
+    def test_429_pauses_and_retries(self):
+        server, runner = self.send({'rate_limit': 100, 'retry_after': 0.2}, GLOBAL_RATE=1000)
+        self.assertGreater(runner.throttled, 0)
+        self.assertEqual(len(server.messages), 300)
+        self.assertEqual(len({chat_id for _, chat_id, _ in server.messages}), 300)
+        self.assertEqual(self.broadcast.sent, 300)
+
+    def test_resume_after_checkpoint(self):
+        halfway = Client.objects.order_by('pk')[149].pk
+        Broadcast.objects.filter(pk=self.broadcast.pk).update(
+            status=Broadcast.RUNNING, last_client_id=halfway, sent=150
+        )
+        server, runner = self.send({'rate_limit': 1000}, GLOBAL_RATE=1000)
+        self.assertEqual(len(server.messages), 150)
+        self.assertTrue(all(chat_id > 150 for _, chat_id, _ in server.messages))
+        self.assertEqual((self.broadcast.sent, self.broadcast.total), (300, 300))
+
+
+class DailyStatsTests(TestCase):
+    def setUp(self):
+        self.service, self.masters, self.client = make_salon()
+        self.day = timezone.localdate() - datetime.timedelta(days=1)
+
+    def book(self, master, hour, **fields):
+        return Appointment.objects.create(
+            client=self.client, master=master, service=self.service, price=self.service.price,
+            start=at(self.day, hour), end=at(self.day, hour, 45), **fields
+        )
+
+    def snapshot(self):
+        # Rows emptied by cancellations stay behind as zeros until the next rebuild.
+        rows = DailyStats.objects.values_list('date', 'master_id', *stats.FIELDS)
+        return sorted(row for row in rows if any(row[2:]))
+
+    def test_incremental_matches_rebuild(self):
+        first = self.book(self.masters[0], 10)
+        second = self.book(self.masters[0], 11)
+        self.book(self.masters[1], 12, status=Appointment.NO_SHOW)
+        first.status = Appointment.COMPLETED
+        first.save()
+        second.start, second.end = at(self.day, 14), at(self.day, 15)
+        second.master = self.masters[1]
+        second.save()
+        second.status = Appointment.CANCELLED
+        second.save(update_fields=['status'])
+        moved = self.book(self.masters[0], 16)
+        moved.start = moved.start + datetime.timedelta(days=1)
+        moved.end = moved.end + datetime.timedelta(days=1)
+        moved.save()
+        moved.delete()
+
+        incremental = self.snapshot()
+        row = DailyStats.objects.get(date=self.day, master=self.masters[0])
+        self.assertEqual((row.booked, row.completed, row.busy_minutes), (0, 1, 45))
+        self.assertEqual(row.revenue, Decimal('1500'))
+        stats.rebuild()
+        self.assertEqual(self.snapshot(), incremental)
+
+    def test_rebuild_command(self):
+        self.book(self.masters[0], 10)
+        Appointment.objects.update(status=Appointment.COMPLETED)
+        call_command('rebuild_stats', stdout=open(os.devnull, 'w'))
+        self.assertEqual(DailyStats.objects.get().completed, 1)
+
+    def test_report_reads_only_aggregates(self):
+        self.book(self.masters[0], 10, status=Appointment.COMPLETED)
+        self.book(self.masters[1], 10, status=Appointment.NO_SHOW)
+        report = stats.master_report(self.day, self.day)
+        self.assertEqual([row['no_show_rate'] for row in report], [0, 1])
+        self.assertAlmostEqual(report[0]['occupancy'], 45 / 480)
+
+        http = self.client_class()
+        http.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        with mock.patch.object(Appointment.objects, 'filter', side_effect=AssertionError):
+            response = http.get(
+                reverse('admin:myapp_dailystats_report'), {'from': self.day, 'to': self.day}
+            )
+        self.assertContains(response, 'Master 1')
+        self.assertContains(response, '100%')
+
+    def test_streaming_export(self):
+        for hour in range(10, 18):
+            self.book(self.masters[0], hour)
+        http = self.client_class()
+        http.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        url = reverse('admin:myapp_dailystats_export')
+        response = http.get(url, {'from': self.day, 'to': self.day})
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(lines[0], ','.join(stats.EXPORT_HEADER))
+        self.assertEqual(len(lines), 9)
+
+        response = http.get(url, {'from': self.day, 'to': self.day, 'format': 'xlsx'})
+        self.assertIn('.xlsx', response['Content-Disposition'])
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+            sheet = archive.read('xl/worksheets/sheet1.xml').decode()
+        self.assertEqual(sheet.count('<row>'), 9)
+        self.assertIn('Anna', sheet)
+
+    def test_report_and_export_need_view_permissions(self):
+        staff = User.objects.create_user('staff', password='pw', is_staff=True)
+        http = self.client_class()
+        http.force_login(staff)
+        report = reverse('admin:myapp_dailystats_report')
+        export_url = reverse('admin:myapp_dailystats_export')
+        self.assertEqual(http.get(report).status_code, 403)
+        self.assertEqual(http.get(export_url).status_code, 403)
+        staff.user_permissions.add(Permission.objects.get(codename='view_dailystats'))
+        self.assertEqual(http.get(report).status_code, 200)
+        self.assertEqual(http.get(export_url).status_code, 403)
+        staff.user_permissions.add(Permission.objects.get(codename='view_appointment'))
+        self.assertEqual(http.get(export_url).status_code, 200)
+
+    def test_csv_cells_are_not_formulas(self):
+        rows = [('=HYPERLINK("http://x")', '+7 900', '-1', '@SUM(A1)', 'Anna', -1, None)]
+        data = ''.join(export.csv_stream(['a', 'b', 'c', 'd', 'e', 'f', 'g'], rows))
+        self.assertEqual(
+            data.splitlines()[1],
+            '"\'=HYPERLINK(""http://x"")",\'+7 900,\'-1,\'@SUM(A1),Anna,-1,',
+        )
+
+    def test_xlsx_cells(self):
+        rows = [(1, Decimal('2.50'), None, 'a < b\x01', True)] * 1200
+        data = b''.join(export.xlsx_stream(['n', 'price', 'empty', 'text', 'flag'], rows))
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip())
+            sheet = archive.read('xl/worksheets/sheet1.xml').decode()
+        self.assertEqual(sheet.count('<row>'), 1201)
+        self.assertIn('<c><v>2.50</v></c><c/>', sheet)
+        self.assertIn('a &lt; b</t>', sheet)
+
+
+class AppointmentAdminTests(TestCase):
+    def setUp(self):
+        self.service, self.masters, self.client_obj = make_salon()
+        self.day = timezone.localdate() + datetime.timedelta(days=1)
+        self.existing = Appointment.objects.create(
+            client=self.client_obj, master=self.masters[0], service=self.service,
+            start=at(self.day, 10), end=at(self.day, 10, 45), price=self.service.price,
+        )
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+
+    def post(self, url, master, hour, minute=0):
+        start = at(self.day, hour, minute)
+        end = start + datetime.timedelta(minutes=45)
+        return self.client.post(url, {
+            'client': self.client_obj.pk, 'master': master.pk, 'service': self.service.pk,
+            'start_0': start.date(), 'start_1': f'{start:%H:%M}',
+            'end_0': end.date(), 'end_1': f'{end:%H:%M}',
+            'price': '1500', 'status': Appointment.BOOKED,
+        })
+
+    def test_overlapping_booking_is_refused(self):
+        url = reverse('admin:myapp_appointment_add')
+        response = self.post(url, self.masters[0], 10, 30)
+        self.assertContains(response, 'already has an appointment at this time')
+        self.assertEqual(self.post(url, self.masters[1], 10, 30).status_code, 302)
+        self.assertEqual(Appointment.objects.count(), 2)
+
+    def test_editing_keeps_own_interval(self):
+        url = reverse('admin:myapp_appointment_change', args=[self.existing.pk])
+        self.assertEqual(self.post(url, self.masters[0], 10, 10).status_code, 302)
+        other = Appointment.objects.create(
+            client=self.client_obj, master=self.masters[0], service=self.service,
+            start=at(self.day, 12), end=at(self.day, 12, 45), price=self.service.price,
+        )
+        url = reverse('admin:myapp_appointment_change', args=[other.pk])
+        self.assertContains(self.post(url, self.masters[0], 10, 30), 'already has an appointment')
+
+
+class KeysetAdminTests(TestCase):
+    # Set ADMIN_CHANGELIST_ROWS=1000000 to run against a production-sized table.
+    rows = int(os.environ.get('ADMIN_CHANGELIST_ROWS', 5000))
+    budget = 5  # session, user, count (first page only), master filter, rows
+
+    @classmethod
+    def setUpTestData(cls):
+        service, cls.masters, client = make_salon(masters=3)
+        clients = Client.objects.bulk_create(
+            Client(telegram_id=100 + i, chat_id=100 + i, name=f'Client {i}') for i in range(50)
+        ) + [client]
+        begin = timezone.now() - datetime.timedelta(days=30)
+        statuses = [Appointment.BOOKED, Appointment.COMPLETED, Appointment.CANCELLED]
+        Appointment.objects.bulk_create(
+            (
+                Appointment(
+                    client=clients[i % len(clients)], master=cls.masters[i % 3], service=service,
+                    # Several appointments share a start, so the id breaks ties.
+                    start=begin + datetime.timedelta(minutes=15 * (i // 4)),
+                    end=begin + datetime.timedelta(minutes=15 * (i // 4) + 45),
+                    price=service.price, status=statuses[i // 3 % 3],
+                )
+                for i in range(cls.rows)
+            ),
+            batch_size=5000,
+        )
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client.force_login(self.admin)
+        self.url = reverse('admin:myapp_appointment_changelist')
+
+    def page(self, url, queries):
+        with self.assertNumQueries(queries):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        cl = response.context['cl']
+        return cl, [obj.pk for obj in cl.result_list]
+
+    def expected(self, **filters):
+        return list(
+            Appointment.objects.filter(**filters).order_by('-start', '-id').values_list('pk', flat=True)
+        )
+
+    def test_query_budget_is_flat(self):
+        expected = self.expected()
+        cl, ids = self.page(self.url, self.budget)
+        self.assertEqual(cl.result_count, self.rows)
+        self.assertEqual(ids, expected[:100])
+        seen = list(ids)
+        for _ in range(3):
+            cl, ids = self.page(self.url + cl.next_page_url, self.budget - 1)
+            seen += ids
+        self.assertEqual(seen, expected[:400])
+        cl, ids = self.page(self.url + cl.previous_page_url, self.budget - 1)
+        self.assertEqual(ids, expected[200:300])
+
+    def test_filtered_pages_use_keyset(self):
+        master = self.masters[1]
+        expected = self.expected(master=master, status=Appointment.BOOKED)
+        url = f'{self.url}?master__id__exact={master.pk}&status__exact=booked'
+        cl, ids = self.page(url, self.budget)
+        self.assertTrue(cl.keyset)
+        self.assertEqual(cl.result_count, len(expected))
+        with CaptureQueriesContext(connection) as queries:
+            cl, ids = self.page(self.url + cl.next_page_url, self.budget - 1)
+        self.assertEqual(ids, expected[100:200])
+        self.assertFalse(any('OFFSET' in query['sql'] for query in queries))
+        self.assertIn(f'master__id__exact={master.pk}', cl.next_page_url)
+
+    def test_upcoming_count_is_cached(self):
+        now = timezone.now().replace(second=10)
+        for seconds, queries in ((10, self.budget), (50, self.budget - 1)):
+            with mock.patch('django.utils.timezone.now', return_value=now.replace(second=seconds)):
+                self.page(self.url + '?day=upcoming', queries)
+
+    def test_other_sort_falls_back_to_pages(self):
+        cl, ids = self.page(self.url + '?o=5', self.budget)
+        self.assertFalse(cl.keyset)
+        self.assertEqual(cl.result_count, self.rows)
+        self.assertEqual(self.client.get(self.url + '?cursor=zzz').status_code, 302)
+
+    def test_related_lookups(self):
+        from .admin import related_lookups
+        self.assertEqual(
+            related_lookups(Appointment, 'service__category__name'), ('service__category', None)
+        )
+        self.assertEqual(related_lookups(Appointment, 'master__services'), ('master', 'master__services'))
+        self.assertEqual(related_lookups(Appointment, 'master_id'), (None, None))
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        for module, name in ((profiling, '_profiler'), (webhook, '_dispatcher')):
+            patcher = mock.patch.object(module, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.service, self.masters, self.client_obj = make_salon()
+        for hour in (10, 12, 14):
+            Appointment.objects.create(
+                client=self.client_obj, master=self.masters[0], service=self.service,
+                start=at(timezone.localdate(), hour), end=at(timezone.localdate(), hour, 45),
+                price=self.service.price,
+            )
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+
+    async def post_update(self, update):
+        await self.async_client.post(
+            reverse('myapp:telegram-webhook'), update, content_type='application/json'
+        )
+        # Handled in the background; finish before the profiler is closed.
+        dispatcher = webhook.get_dispatcher()
+        await dispatcher.join()
+        await dispatcher.stop()
+
+    def test_disabled_by_default(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            profiling.ProfilingMiddleware(lambda request: None)
+
+    def test_views_are_recorded_and_dumped(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'profile.json')
+            with self.settings(PROFILING={'ENABLED': True, 'DUMP_PATH': path}):
+                for _ in range(3):
+                    self.client.get(reverse('admin:myapp_appointment_changelist'))
+                async_to_sync(self.post_update)({'update_id': 1})
+                response = self.client.get(reverse('myapp:profiling-stats'))
+                profiling.get_profiler().close()
+            with open(path) as fh:
+                dumped = json.load(fh)
+        views = response.json()['views']
+        changelist = views['GET admin:myapp_appointment_changelist']
+        self.assertEqual(changelist['requests'], 3)
+        self.assertGreaterEqual(changelist['queries']['max'], 4)
+        self.assertEqual(changelist['n_plus_one'], 0)
+        self.assertEqual(set(changelist['wall_ms']), {'mean', 'p50', 'p95', 'p99'})
+        self.assertEqual(views['POST myapp:telegram-webhook']['requests'], 1)
+        self.assertEqual(dumped['views'][profiling.UPDATE_VIEW]['requests'], 1)
+        self.assertIn('GET myapp:profiling-stats', dumped['views'])
+
+    def test_updates_are_profiled_apart_from_the_request(self):
+        def handler(update):
+            list(Appointment.objects.all())
+
+        profiler = profiling.Profiler()
+
+        async def scenario():
+            dispatcher = webhook.UpdateDispatcher(handler, workers=2, profiler=profiler)
+            # The first update starts the workers inside the request's log.
+            with profiling.record_queries() as request_log:
+                await dispatcher.submit(message_update(1, 1))
+            await dispatcher.submit(message_update(2, 2))
+            await dispatcher.join()
+            await dispatcher.stop()
+            return request_log
+
+        request_log = async_to_sync(scenario)()
+        self.assertEqual(request_log.count, 0)
+        view = profiler.stats()['views'][profiling.UPDATE_VIEW]
+        self.assertEqual((view['requests'], view['queries']['max']), (2, 1))
+
+    def test_n_plus_one_is_reported(self):
+        profiler = profiling.Profiler(duplicate_threshold=3)
+        with profiling.record_queries() as log:
+            names = [item.client.name for item in Appointment.objects.all()]
+        self.assertEqual(names, ['Anna'] * 3)
+        with self.assertLogs('myapp.profiling', 'WARNING'):
+            profiler.record('GET test', 200, 0.01, log)
+        view = profiler.stats()['views']['GET test']
+        self.assertEqual((view['queries']['max'], view['n_plus_one']), (4, 1))
+        self.assertEqual(view['duplicate']['times'], 3)
+
+
+def seed_salon(masters, services, clients, days, horizon=14, seed=1):
+    """
+    A salon with ``days`` of history and ``horizon`` days of bookings ahead,
+    each master's day about two-thirds full.
+    """
+    rng = random.Random(seed)
+    categories = Category.objects.bulk_create(
+        Category(name=f'Category {i}', position=i) for i in range(max(1, services // 5))
+    )
+    service_list = Service.objects.bulk_create(
+        Service(
+            category=categories[i % len(categories)], name=f'Service {i}',
+            price=Decimal(500 + 100 * (i % 20)), duration_minutes=rng.choice([30, 45, 60, 90]),
+        )
+        for i in range(services)
+    )
+    master_list = Master.objects.bulk_create(
+        Master(name=f'Master {i}', work_start=datetime.time(10), work_end=datetime.time(20))
+        for i in range(masters)
+    )
+    offered = {
+        master.pk: rng.sample(service_list, max(1, len(service_list) // 2)) for master in master_list
+    }
+    Master.services.through.objects.bulk_create(
+        Master.services.through(master_id=master_id, service=service)
+        for master_id, items in offered.items()
+        for service in items
+    )
+    client_list = Client.objects.bulk_create(
+        Client(telegram_id=10 ** 6 + i, chat_id=10 ** 6 + i, name=f'Client {i}')
+        for i in range(clients)
+    )
+
+    def appointments():
+        today = timezone.localdate()
+        for offset in range(-days, horizon):
+            day = today + datetime.timedelta(days=offset)
+            for master in master_list:
+                start = at(day, 10)
+                while True:
+                    service = rng.choice(offered[master.pk])
+                    end = start + datetime.timedelta(minutes=service.duration_minutes)
+                    if end > at(day, 20):
+                        break
+                    if rng.random() < 0.7:
+                        if offset < 0:
+                            status = rng.choices(
+                                [Appointment.COMPLETED, Appointment.NO_SHOW, Appointment.CANCELLED],
+                                [80, 8, 12],
+                            )[0]
+                        else:
+                            status = rng.choices([Appointment.BOOKED, Appointment.CANCELLED], [9, 1])[0]
+                        yield Appointment(
+                            client=rng.choice(client_list), master=master, service=service,
+                            start=start, end=end, price=service.price, status=status,
+                        )
+                        start = end
+                    else:
+                        start += datetime.timedelta(minutes=30)
+
+    Appointment.objects.bulk_create(appointments(), batch_size=2000)
+    stats.rebuild()
+    availability.index.reset()
+    catalog.cache.clear()
+    return service_list, master_list, client_list
+
+
+@tag('benchmark')
+@override_settings(PROFILING={'ENABLED': True})
+class BenchmarkTests(TransactionTestCase):
+    """
+    Times the hot paths on a synthetic salon.
+
+    The salon's size comes from BENCHMARK_MASTERS, BENCHMARK_SERVICES,
+    BENCHMARK_CLIENTS and BENCHMARK_YEARS (of booking history).  Results are
+    written as JSON to BENCHMARK_OUTPUT; when BENCHMARK_BASELINE names an
+    earlier result file, a p50 more than BENCHMARK_TOLERANCE (0.25 = 25%)
+    slower than the baseline, or any extra query, fails the test.  Queries
+    made by the booking writer's own thread are not counted.
+
+        BENCHMARK_YEARS=3 BENCHMARK_OUTPUT=bench.json manage.py test --tag benchmark
+    """
+    masters = int(os.environ.get('BENCHMARK_MASTERS', 5))
+    services = int(os.environ.get('BENCHMARK_SERVICES', 10))
+    clients = int(os.environ.get('BENCHMARK_CLIENTS', 200))
+    years = float(os.environ.get('BENCHMARK_YEARS', 0.1))
+    repeat = int(os.environ.get('BENCHMARK_REPEAT', 50))
+
+    def setUp(self):
+        patcher = mock.patch.object(profiling, '_profiler', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        caches['default'].clear()
+        began = time.perf_counter()
+        self.service_list, self.master_list, self.client_list = seed_salon(
+            self.masters, self.services, self.clients, int(self.years * 365)
+        )
+        self.seed_time = time.perf_counter() - began
+        self.results = {}
+
+    def measure(self, name, run, repeat=None):
+        repeat = repeat or self.repeat
+        window = webhook.LatencyWindow(repeat)
+        total = 0.0
+        queries = 0
+        for i in range(repeat):
+            with profiling.record_queries() as log:
+                began = time.perf_counter()
+                run(i)
+                elapsed = time.perf_counter() - began
+            window.add(elapsed)
+            total += elapsed
+            queries = max(queries, log.count)
+        self.results[name] = {
+            'runs': repeat,
+            'mean': round(total / repeat * 1000, 3),
+            **window.percentiles(50, 95, 99),
+            'queries': queries,
+        }
+        return self.results[name]
+
+    def bench_slot_search(self):
+        now = timezone.now()
+        services = self.service_list
+        self.measure(
+            'slot_search_cold',
+            lambda i: (availability.index.reset(), availability.find_free_slots(
+                services[i % len(services)], count=10, days=14, now=now
+            )),
+            repeat=max(5, self.repeat // 10),
+        )
+        warm = self.measure(
+            'slot_search',
+            lambda i: availability.find_free_slots(services[i % len(services)], count=10, days=14, now=now),
+        )
+        self.assertEqual(warm['queries'], 0)
+
+    def bench_booking_commit(self):
+        writer = booking.BookingWriter()
+        self.addCleanup(writer.stop)
+        rng = random.Random(7)
+        day = timezone.localdate() + datetime.timedelta(days=30)
+        masters = list(Master.objects.prefetch_related('services'))
+        outcomes = collections.Counter()
+
+        def book(i):
+            master = rng.choice(masters)
+            service = rng.choice(master.services.all())
+            start = at(day + datetime.timedelta(days=i // 20), 10, 0) + datetime.timedelta(
+                minutes=15 * rng.randrange(32)
+            )
+            client = rng.choice(self.client_list)
+            outcomes[writer.book(client.pk, master.pk, service.pk, start).status] += 1
+
+        self.measure('booking_commit', book)
+        self.assertEqual(sum(outcomes.values()), self.repeat)
+        self.assertGreater(outcomes[booking.BOOKED], 0)
+
+    def bench_catalog_render(self):
+        category_id = self.service_list[0].category_id
+        service_id = self.service_list[0].pk
+
+        def render(i):
+            catalog.categories_screen()
+            catalog.services_screen(category_id)
+            catalog.masters_screen(service_id)
+            catalog.price_list_screen()
+
+        self.measure('catalog_render_cold', lambda i: (catalog.cache.clear(), render(i)))
+        warm = self.measure('catalog_render', render)
+        self.assertEqual(warm['queries'], 0)
+
+    def bench_webhook(self):
+        store = state.MemoryStateBackend()
+        api = FakeBotAPI()
+        for name, value in (('get_store', store), ('get_api', api)):
+            patcher = mock.patch.object(bot, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        service = self.service_list[0]
+        steps = ['catalog', f'cat:{service.category_id}', f'svc:{service.pk}', f'mst:{service.pk}:0']
+
+        def callback(i):
+            return {
+                'update_id': i,
+                'callback_query': {
+                    'id': str(i), 'data': steps[i % len(steps)], 'from': {'id': 1 + i % 10},
+                    'message': {'message_id': 1, 'chat': {'id': 1 + i % 10}},
+                },
+            }
+
+        self.measure('webhook_update', lambda i: async_to_sync(bot.handle_update)(callback(i)))
+        url = reverse('myapp:telegram-webhook')
+
+        async def post(i):
+            await self.async_client.post(
+                url, callback(10 ** 6 + i), content_type='application/json'
+            )
+            if i == self.repeat - 1:
+                await webhook.get_dispatcher().join()
+
+        self.measure('webhook_view', async_to_sync(post))
+
+    def bench_admin(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        url = reverse('admin:myapp_appointment_changelist')
+        next_url = url + self.client.get(url).context['cl'].next_page_url
+        repeat = max(5, self.repeat // 5)
+        for name, target in (
+            ('admin_appointments', url),
+            ('admin_appointments_next', next_url),
+            ('admin_appointments_booked', url + '?status__exact=booked'),
+            ('admin_clients', reverse('admin:myapp_client_changelist')),
+        ):
+            result = self.measure(name, lambda i, target=target: self.client.get(target), repeat)
+            self.assertLessEqual(result['queries'], 5, name)
+
+    def compare(self, baseline, tolerance):
+        regressions = []
+        for name, old in baseline['results'].items():
+            new = self.results.get(name)
+            if new is None:
+                continue
+            if new['p50'] > old['p50'] * (1 + tolerance) and new['p50'] - old['p50'] > 0.05:
+                regressions.append(f'{name}: p50 {old["p50"]} ms -> {new["p50"]} ms')
+            if new['queries'] > old['queries']:
+                regressions.append(f'{name}: {old["queries"]} -> {new["queries"]} queries')
+        return regressions
+
+    def test_hot_paths(self):
+        self.bench_slot_search()
+        self.bench_booking_commit()
+        self.bench_catalog_render()
+        self.bench_webhook()
+        self.bench_admin()
+        report = {
+            'salon': {
+                'masters': self.masters,
+                'services': self.services,
+                'clients': self.clients,
+                'years': self.years,
+                'appointments': Appointment.objects.count(),
+                'seed_seconds': round(self.seed_time, 2),
+            },
+            'results': self.results,
+            'views': profiling.get_profiler().stats()['views'],
+        }
+        if output := os.environ.get('BENCHMARK_OUTPUT'):
+            with open(output, 'w') as fh:
+                json.dump(report, fh, indent=2)
+        if baseline_path := os.environ.get('BENCHMARK_BASELINE'):
+            with open(baseline_path) as fh:
+                baseline = json.load(fh)
+            regressions = self.compare(baseline, float(os.environ.get('BENCHMARK_TOLERANCE', 0.25)))
+            if regressions:
+                self.fail('Slower than the baseline:\n' + '\n'.join(regressions))
+
+
+class BroadcastClaimTests(TestCase):
+    def setUp(self):
+        self.broadcast = Broadcast.objects.create(text='Акция')
+
+    def test_only_one_run_claims(self):
+        first = claim(self.broadcast.pk)
+        self.assertIsNotNone(first)
+        self.assertIsNone(claim(self.broadcast.pk))
+        with mock.patch('myapp.broadcast.run_broadcast') as run:
+            self.assertIsNone(broadcast.start_in_background(self.broadcast.pk))
+        run.assert_not_called()
+        self.broadcast.refresh_from_db()
+        self.assertEqual((self.broadcast.status, self.broadcast.runner), (Broadcast.RUNNING, first))
+
+    def test_stale_or_forced_run_can_be_taken_over(self):
+        claim(self.broadcast.pk)
+        self.assertIsNotNone(claim(self.broadcast.pk, force=True))
+        Broadcast.objects.filter(pk=self.broadcast.pk).update(
+            heartbeat_at=timezone.now() - datetime.timedelta(hours=1)
+        )
+        token = claim(self.broadcast.pk)
+        self.assertIsNotNone(token)
+        Broadcast.objects.filter(pk=self.broadcast.pk).update(status=Broadcast.DONE)
+        self.assertIsNone(claim(self.broadcast.pk, force=True))
+
+    def test_run_that_lost_its_claim_does_not_start(self):
+        stale = claim(self.broadcast.pk)
+        claim(self.broadcast.pk, force=True)
+        runner = BroadcastRunner(self.broadcast.pk, api=FakeBotAPI(), token=stale)
+        self.assertIsNone(async_to_sync(runner.run)())
+
+    def test_admin_action_starts_once(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        url = reverse('admin:myapp_broadcast_changelist')
+        data = {'action': 'start_broadcast', '_selected_action': [self.broadcast.pk]}
+        with mock.patch('myapp.broadcast.run_broadcast') as run:
+            self.client.post(url, data)
+            response = self.client.post(url, data, follow=True)
+            for thread in threading.enumerate():
+                if thread.name == f'broadcast-{self.broadcast.pk}':
+                    thread.join()
+        self.assertEqual(run.call_count, 1)
+        self.assertContains(response, 'is already being sent')
+
+    def test_actions_need_change_permission(self):
+        staff = User.objects.create_user('staff', password='pw', is_staff=True)
+        staff.user_permissions.add(Permission.objects.get(codename='view_broadcast'))
+        self.client.force_login(staff)
+        url = reverse('admin:myapp_broadcast_changelist')
+        self.assertNotContains(self.client.get(url), 'start_broadcast')
+        data = {'action': 'start_broadcast', '_selected_action': [self.broadcast.pk]}
+        with mock.patch('myapp.broadcast.start_in_background') as start:
+            self.client.post(url, data)
+        start.assert_not_called()
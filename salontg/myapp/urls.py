@@ -0,0 +1,11 @@
+from django.urls import path
+
+from . import views
+
+app_name = 'myapp'
+
+urlpatterns = [
+    path('telegram/webhook/', views.telegram_webhook, name='telegram-webhook'),
+    path('telegram/stats/', views.telegram_stats, name='telegram-stats'),
+    path('profiling/stats/', views.profiling_stats, name='profiling-stats'),
+]
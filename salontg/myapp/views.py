@@ -1,3 +1,43 @@
-from django.shortcuts import render
+import json
 
-# Create your views here.
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from . import catalog, profiling, webhook
+
+
+@csrf_exempt
+@require_POST
+async def telegram_webhook(request):
+    secret = getattr(settings, 'TELEGRAM_WEBHOOK_SECRET', '')
+    if secret and not constant_time_compare(
+        request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), secret
+    ):
+        return HttpResponseForbidden()
+    try:
+        update = json.loads(request.body)
+    except ValueError:
+        return HttpResponse(status=400)
+    if not isinstance(update, dict):
+        return HttpResponse(status=400)
+    result = await webhook.get_dispatcher().submit(update)
+    if result == webhook.REJECTED:
+        return HttpResponse(status=503, headers={'Retry-After': '1'})
+    return HttpResponse()
+
+
+async def telegram_stats(request):
+    user = await request.auser()
+    if not user.is_staff:
+        return HttpResponseForbidden()
+    return JsonResponse({**webhook.get_dispatcher().stats(), 'catalog': catalog.cache.stats()})
+
+
+async def profiling_stats(request):
+    user = await request.auser()
+    if not user.is_staff:
+        return HttpResponseForbidden()
+    return JsonResponse(profiling.get_profiler().stats())
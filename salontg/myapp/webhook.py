@@ -0,0 +1,216 @@
+"""
+Asynchronous ingestion of Telegram webhook updates.
+
+The webhook view only hands an update to ``UpdateDispatcher.submit()`` and
+answers right away.  Updates are spread over a fixed set of worker shards by
+chat id, so messages from one chat are handled in the order they arrived while
+different chats are processed in parallel.  Each shard has a bounded queue;
+when it is full the update is either rejected (Telegram retries it later) or
+the caller waits up to ``PUT_TIMEOUT`` seconds, depending on ``WHEN_FULL``.
+
+Telegram re-delivers updates it considers unanswered, so recently seen
+``update_id``s are remembered and repeats are dropped.
+
+With profiling on (see ``myapp.profiling``), each update is recorded as a
+request to ``telegram:update``.
+"""
+import asyncio
+import collections
+import contextvars
+import inspect
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import profiling
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+DUPLICATE = 'duplicate'
+REJECTED = 'rejected'
+
+DEFAULTS = {
+    'HANDLER': 'myapp.bot.handle_update',
+    'WORKERS': 8,
+    'QUEUE_SIZE': 2000,
+    'DEDUP_SIZE': 10000,
+    'WHEN_FULL': 'reject',
+    'PUT_TIMEOUT': 0.5,
+}
+
+_CHAT_PATHS = (
+    ('message', 'chat'),
+    ('edited_message', 'chat'),
+    ('channel_post', 'chat'),
+    ('callback_query', 'message', 'chat'),
+    ('my_chat_member', 'chat'),
+    ('callback_query', 'from'),
+    ('inline_query', 'from'),
+    ('pre_checkout_query', 'from'),
+)
+
+
+def chat_key(update):
+    """The chat an update belongs to, falling back to the update id."""
+    for path in _CHAT_PATHS:
+        node = update
+        for part in path:
+            node = node.get(part) if isinstance(node, dict) else None
+        if isinstance(node, dict) and 'id' in node:
+            return node['id']
+    return update.get('update_id')
+
+
+class LatencyWindow:
+    """Sliding window of the most recent latencies, in seconds."""
+
+    def __init__(self, size=2048):
+        self._samples = collections.deque(maxlen=size)
+
+    def add(self, value):
+        self._samples.append(value)
+
+    def percentiles(self, *points):
+        samples = sorted(self._samples)
+        if not samples:
+            return {f'p{point}': None for point in points}
+        last = len(samples) - 1
+        return {
+            f'p{point}': round(samples[min(last, int(last * point / 100 + 0.5))] * 1000, 3)
+            for point in points
+        }
+
+
+class UpdateDispatcher:
+    def __init__(self, handler, workers=8, queue_size=2000, dedup_size=10000,
+                 when_full='reject', put_timeout=0.5, profiler=None):
+        if when_full not in ('reject', 'wait'):
+            raise ValueError("when_full must be 'reject' or 'wait'.")
+        if not inspect.iscoroutinefunction(handler):
+            handler = sync_to_async(handler)
+        self.handler = handler
+        self.workers = workers
+        self.shard_size = max(1, queue_size // workers)
+        self.dedup_size = dedup_size
+        self.when_full = when_full
+        self.put_timeout = put_timeout
+        self.profiler = profiler
+        self._seen = collections.OrderedDict()
+        self._loop = None
+        self._queues = []
+        self._tasks = []
+        self.latency = LatencyWindow()
+        self.counters = collections.Counter()
+
+    @classmethod
+    def from_settings(cls):
+        config = {**DEFAULTS, **getattr(settings, 'TELEGRAM_WEBHOOK', {})}
+        return cls(
+            import_string(config['HANDLER']),
+            workers=config['WORKERS'],
+            queue_size=config['QUEUE_SIZE'],
+            dedup_size=config['DEDUP_SIZE'],
+            when_full=config['WHEN_FULL'],
+            put_timeout=config['PUT_TIMEOUT'],
+            profiler=profiling.get_profiler() if profiling.is_enabled() else None,
+        )
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        # First update on this event loop (or the previous loop is gone).
+        self._loop = loop
+        self._queues = [asyncio.Queue(self.shard_size) for _ in range(self.workers)]
+        # Not the context of the request that happened to start them.
+        self._tasks = [
+            loop.create_task(self._work(queue), context=contextvars.Context())
+            for queue in self._queues
+        ]
+
+    def _remember(self, update_id):
+        if update_id in self._seen:
+            return False
+        self._seen[update_id] = None
+        if len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
+        return True
+
+    async def submit(self, update):
+        """Queue ``update`` and return QUEUED, DUPLICATE or REJECTED."""
+        self._ensure_started()
+        self.counters['received'] += 1
+        update_id = update.get('update_id')
+        if update_id is not None and not self._remember(update_id):
+            self.counters['duplicates'] += 1
+            return DUPLICATE
+        queue = self._queues[hash(chat_key(update)) % self.workers]
+        item = (update, time.perf_counter())
+        try:
+            if self.when_full == 'wait':
+                await asyncio.wait_for(queue.put(item), self.put_timeout)
+            else:
+                queue.put_nowait(item)
+        except (asyncio.QueueFull, TimeoutError):
+            # Let Telegram deliver it again once the backlog has drained.
+            self._seen.pop(update_id, None)
+            self.counters['rejected'] += 1
+            return REJECTED
+        return QUEUED
+
+    async def _work(self, queue):
+        while True:
+            update, queued_at = await queue.get()
+            try:
+                if self.profiler is None:
+                    await self.handler(update)
+                else:
+                    with self.profiler.profile(profiling.UPDATE_VIEW):
+                        await self.handler(update)
+            except Exception:
+                self.counters['failed'] += 1
+                logger.exception('Failed to handle update %s', update.get('update_id'))
+            else:
+                self.counters['processed'] += 1
+            finally:
+                self.latency.add(time.perf_counter() - queued_at)
+                queue.task_done()
+
+    async def join(self):
+        """Wait until every queued update has been handled."""
+        for queue in self._queues:
+            await queue.join()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._loop = None
+        self._queues = []
+        self._tasks = []
+
+    def stats(self):
+        depths = [queue.qsize() for queue in self._queues]
+        return {
+            'queue_depth': sum(depths),
+            'max_shard_depth': max(depths, default=0),
+            'queue_capacity': self.shard_size * self.workers,
+            'workers': self.workers,
+            **{name: self.counters[name] for name in
+               ('received', 'duplicates', 'rejected', 'processed', 'failed')},
+            'latency_ms': self.latency.percentiles(50, 95, 99),
+        }
+
+
+_dispatcher = None
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = UpdateDispatcher.from_settings()
+    return _dispatcher
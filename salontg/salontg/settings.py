@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'myapp.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -73,10 +75,20 @@ WSGI_APPLICATION = 'salontg.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
+# Appointment writes go through a single writer thread (myapp.booking); WAL
+# keeps readers running while it commits.
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': None,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -112,7 +124,137 @@ USE_I18N = True
 USE_TZ = True
 
 
+# Appointment reminders
+# Sent by `python manage.py run_reminders`; see myapp.reminders for the
+# reminder offsets and other options.
+
+REMINDERS = {
+    # Seconds between checks for booked, moved and cancelled appointments.
+    'POLL_INTERVAL': 5.0,
+}
+
+
+# Broadcasts
+# Sent from the admin or `python manage.py broadcast`; see myapp.broadcast.
+# `python manage.py fake_bot_api` runs a local Bot API for offline tests.
+
+BROADCAST = {
+    # Messages per second overall (Telegram allows about 30) and per chat.
+    'GLOBAL_RATE': 28,
+    'PER_CHAT_RATE': 1,
+    # Requests in flight at once over the pooled HTTP client.
+    'CONCURRENCY': 32,
+    # Progress is saved every this many messages.
+    'CHECKPOINT_EVERY': 200,
+}
+
+
+# Bot dialog state
+# Per-chat wizard state lives in memory (myapp.state), not in django_session.
+
+BOT_STATE = {
+    'BACKEND': 'myapp.state.MemoryStateBackend',
+    'OPTIONS': {
+        'ttl': 24 * 60 * 60,
+        'max_entries': 200_000,
+        'snapshot_path': BASE_DIR / 'dialog_state.json',
+        'snapshot_interval': 60,
+    },
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/6.0/topics/cache/
+# Besides regular caching this holds the catalog version counters used by
+# myapp.catalog; with several bot processes point it at a shared backend
+# (Redis, Memcached) so that admin edits reach all of them.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Catalog version counters only, so that other cache use never culls them.
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalog-versions',
+    },
+}
+
+CATALOG_CACHE = {
+    'CACHE_ALIAS': 'catalog',
+    'MAX_ENTRIES': 512,
+    'TTL': 600,
+    # Seconds between checks for version bumps made by other processes.
+    'VERSION_CHECK_INTERVAL': 1.0,
+}
+
+
+# Admin changelists
+# Appointment and client lists cache their row count for this many seconds;
+# on PostgreSQL, counts the planner estimates above ESTIMATE_ABOVE are shown
+# as approximate instead of being counted.
+
+ADMIN_CHANGELIST = {
+    'CACHE_ALIAS': 'default',
+    'COUNT_CACHE_TIMEOUT': 60,
+    'ESTIMATE_ABOVE': 100000,
+}
+
+
+# Profiling
+# Per-view wall time, SQL count/time and N+1 detection (myapp.profiling).
+# Off by default; set PROFILING=1 in the environment to turn it on.  Stats are
+# served at /profiling/stats/ and dumped to DUMP_PATH.
+
+PROFILING = {
+    'ENABLED': os.environ.get('PROFILING') == '1',
+    'DUMP_PATH': BASE_DIR / 'profile.json',
+    'DUMP_INTERVAL': 60.0,
+    # A statement run this many times in one request is reported as N+1.
+    'DUPLICATE_THRESHOLD': 3,
+}
+
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/6.0/howto/static-files/
 
 STATIC_URL = 'static/'
+
+
+# Booking
+# How many days ahead the bot offers free slots.
+
+BOOKING_HORIZON_DAYS = 14
+
+# Seconds after which the bot re-reads a day's bookings, to pick up changes
+# made by other processes (the admin, other workers, a shell).
+AVAILABILITY_MAX_AGE = 60
+
+# Largest number of operations committed in one transaction, and how long
+# (seconds) the writer waits for more operations before committing.
+BOOKING_WRITER = {
+    'BATCH_SIZE': 200,
+    'BATCH_DELAY': 0.002,
+}
+
+
+# Telegram
+# The webhook is served by the ASGI application (salontg.asgi); updates are
+# queued and handled by a pool of workers, see myapp.webhook.
+
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
+
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+TELEGRAM_WEBHOOK_SECRET = os.environ.get('TELEGRAM_WEBHOOK_SECRET', '')
+
+TELEGRAM_WEBHOOK = {
+    'HANDLER': 'myapp.bot.handle_update',
+    'WORKERS': 8,
+    'QUEUE_SIZE': 2000,
+    'DEDUP_SIZE': 10000,
+    # 'reject' answers 503 so Telegram retries later; 'wait' blocks the
+    # request for up to PUT_TIMEOUT seconds before rejecting.
+    'WHEN_FULL': 'reject',
+    'PUT_TIMEOUT': 0.5,
+}